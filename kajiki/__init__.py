@@ -1,6 +1,46 @@
-from util import expose, flattener
+import sys
+from types import ModuleType
+
+# Names which live in modules that are only imported on first use, so that
+# rendering precompiled templates never imports the compilers
+_lazy_names = dict(
+    XMLTemplate='xml_template',
+    TextTemplate='text',
+    MockLoader='loader',
+    FileLoader='loader',
+    PackageLoader='loader',
+    PrecompiledLoader='loader')
+_submodules = set([
+    'cache', 'compile', 'ddict', 'html_utils', 'i18n', 'ir', 'lnotab',
+    'loader', 'markup_template', 'runtime', 'template', 'text', 'util',
+    'version', 'xml_template'])
+
+class _Package(ModuleType):
+    '''The kajiki package, importing its lazy names on first access'''
+
+    def __getattr__(self, name):
+        if name in _submodules:
+            __import__(self.__name__ + '.' + name)
+            return ModuleType.__getattribute__(self, name)
+        modname = _lazy_names.get(name)
+        if modname is None:
+            raise AttributeError(name)
+        value = getattr(getattr(self, modname), name)
+        setattr(self, name, value)
+        return value
+
+# Install the package object before importing any submodule so that their
+# 'import kajiki' sees it.  It keeps a reference to this module because the
+# functions defined here use this module's globals.
+_package = _Package(__name__, __doc__)
+_package.__dict__.update(
+    __file__=__file__, __path__=__path__, _module=sys.modules[__name__])
+sys.modules[__name__] = _package
+
+from util import expose, flattener, rendered
 from template import Template
-from loader import MockLoader, FileLoader, PackageLoader
-from text import TextTemplate
-from xml_template import XMLTemplate
 from version import __version__, __release__
+
+_package.__dict__.update(
+    expose=expose, flattener=flattener, rendered=rendered,
+    Template=Template, __version__=__version__, __release__=__release__)
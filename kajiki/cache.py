@@ -0,0 +1,140 @@
+'''Caches used by templates and loaders
+
+CodeCache - stores the code generated for each template source in a directory
+so that later processes can skip parsing and compiling templates altogether.
+MemoryStore - bounded in-process store of rendered fragments (py:cache).
+default_fragment_cache - the MemoryStore used by templates which have no
+fragment cache of their own.
+'''
+import os
+import imp
+import time
+import marshal
+import tempfile
+from threading import Lock
+from collections import OrderedDict
+try:
+    from hashlib import sha1
+except ImportError: # pragma no cover
+    from sha import new as sha1
+
+from version import __release__
+
+class CodeCache(object):
+    '''Content-addressed store of compiled templates.  Entries are keyed on
+    the template source, its compile options, the kajiki release and the
+    Python bytecode version, so stale entries are never loaded and the
+    directory may be shared between processes.'''
+    suffix = '.kjc'
+    # Bumped whenever the layout of the entries changes
+    version = 4
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another process may have created it in the meantime
+                if not os.path.isdir(directory): raise
+
+    def key(self, source, *options):
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+            options = ('unicode',) + options
+        digest = sha1(imp.get_magic())
+        digest.update('%s:%d' % (__release__, self.version))
+        digest.update(repr(options))
+        digest.update('\0')
+        digest.update(source)
+        return digest.hexdigest()
+
+    def get(self, key):
+        '''Return the (code, py_text, py_linenos, deps) entry for key, or
+        None.  deps are the (name, digest) pairs of the templates inlined in
+        the code.'''
+        try:
+            f = open(self._path(key), 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                return marshal.loads(f.read())
+            except (EOFError, ValueError, TypeError):
+                return None
+        finally:
+            f.close()
+
+    def put(self, key, entry):
+        data = marshal.dumps(entry)
+        # Write to a private file and rename it into place so that readers
+        # in other processes never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(
+            suffix=self.suffix, prefix='.tmp', dir=self.directory)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(tmp_path, self._path(key))
+        except (IOError, OSError):
+            # The entry is only an optimization; if another process won
+            # the race (or the directory is read-only) just drop ours
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+class MemoryStore(object):
+    '''Fragment store keeping the max_entries most recently used fragments
+    in memory.  Entries expire ttl seconds after they were set (never if
+    ttl is None), ttl defaulting to default_ttl.
+
+    Fragment stores only need get(key) -> text or None and
+    set(key, text, ttl), keys and texts being unicode strings, so a store
+    shared between processes (memcached, redis...) is easily plugged in.'''
+
+    def __init__(self, max_entries=1000, default_ttl=None):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        # key => (expiry time or None, text), oldest first
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, text = entry
+            if expires is not None and expires <= time.time():
+                return None
+            # Move the entry to the most recently used end
+            self._entries[key] = entry
+            return text
+
+    def set(self, key, text, ttl=None):
+        if ttl is None:
+            ttl = self.default_ttl
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+        with self._lock:
+            entries = self._entries
+            entries.pop(key, None)
+            entries[key] = (expires, text)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+default_fragment_cache = MemoryStore()
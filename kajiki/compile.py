@@ -0,0 +1,153 @@
+'''Ahead-of-time template compiler
+
+Compiles every template below a directory into a Python module, so that a
+deployment can load its templates with a PrecompiledLoader without parsing
+or compiling anything at runtime::
+
+    python -m kajiki.compile [options] SOURCE_DIR OUTPUT_DIR
+
+Each template SOURCE_DIR/<name> becomes OUTPUT_DIR/<name>.py together with
+its byte-compiled OUTPUT_DIR/<name>.pyc.  Templates are compiled by a pool of
+worker processes.
+'''
+import os
+import sys
+import py_compile
+from ast import literal_eval
+from optparse import OptionParser
+
+from loader import FileLoader
+from version import __release__
+
+MODULE_HEADER = '''# -*- coding: utf-8 -*-
+# Compiled from %s by kajiki %s -- do not edit
+import kajiki
+'''
+MODULE_FOOTER = '''
+kajiki.template.from_globals(globals(), None, %r, %r)
+'''
+
+def find_templates(base, extensions=None):
+    '''Return the names (relative paths) of all templates below base'''
+    if extensions is None:
+        extensions = ('xml', 'html', 'html5', 'txt')
+    result = []
+    for dirpath, dirnames, filenames in os.walk(base):
+        dirnames.sort()
+        for fn in sorted(filenames):
+            if os.path.splitext(fn)[1][1:] not in extensions: continue
+            path = os.path.join(dirpath, fn)
+            result.append(os.path.relpath(path, base))
+    return result
+
+def module_source(tpl):
+    '''Return the text of a module which defines the compiled template tpl'''
+    header = MODULE_HEADER % (tpl.filename, __release__)
+    offset = header.count('\n')
+    py_linenos = [ (py_lineno + offset, tpl_lineno)
+                   for py_lineno, tpl_lineno in tpl.py_linenos ]
+    py_text = tpl.py_text
+    if isinstance(py_text, unicode):
+        py_text = py_text.encode('utf-8')
+    return (header + py_text
+            + MODULE_FOOTER % (py_linenos, tpl.filename))
+
+def compile_template(loader, name, dest):
+    '''Compile the template name from loader into a module below dest and
+    return the path of the module'''
+    tpl = loader.import_(name)
+    path = os.path.join(dest, name) + '.py'
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # Another worker may have created it in the meantime
+            if not os.path.isdir(dirname): raise
+    f = open(path, 'wb')
+    try:
+        f.write(module_source(tpl))
+    finally:
+        f.close()
+    py_compile.compile(path, doraise=True)
+    return path
+
+_worker = None
+
+def _init_worker(src, dest, options):
+    global _worker
+    _worker = (FileLoader(src, reload=False, **options), dest)
+
+def _compile_one(name):
+    loader, dest = _worker
+    return compile_template(loader, name, dest)
+
+def compile_tree(src, dest, jobs=None, names=None, **options):
+    '''Compile the templates below src into modules below dest using jobs
+    worker processes (one per CPU by default).  options are passed on to the
+    FileLoader used to compile the templates.  Returns the list of module
+    paths written.'''
+    if names is None:
+        names = find_templates(src)
+    if jobs == 1 or len(names) < 2:
+        _init_worker(src, dest, options)
+        return map(_compile_one, names)
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs, _init_worker, (src, dest, options))
+    try:
+        result = pool.map(_compile_one, names)
+    finally:
+        pool.close()
+        pool.join()
+    return result
+
+def main(argv=None):
+    parser = OptionParser(
+        usage='python -m kajiki.compile [options] SOURCE_DIR OUTPUT_DIR')
+    parser.add_option(
+        '-j', '--jobs', type='int', default=None,
+        help='number of worker processes (default: one per CPU)')
+    parser.add_option(
+        '-m', '--force-mode', default=None,
+        help='compile all templates in this mode (xml, html, html5 or text)')
+    parser.add_option(
+        '--autoescape-text', action='store_true', default=False,
+        help='escape expressions in text templates')
+    parser.add_option(
+        '--buffered', action='store_true', default=False,
+        help='generate buffered rendering code')
+    parser.add_option(
+        '--inline-includes', action='store_true', default=False,
+        help='inline the templates included with a constant name')
+    parser.add_option(
+        '-D', '--define', action='append', default=[], metavar='NAME=VALUE',
+        help='define the compile-time constant NAME, whose VALUE is a '
+        'Python literal')
+    parser.add_option(
+        '-q', '--quiet', action='store_true', default=False,
+        help='do not list the compiled templates')
+    opts, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error('expected SOURCE_DIR and OUTPUT_DIR')
+    src, dest = args
+    constants = {}
+    for define in opts.define:
+        name, sep, value = define.partition('=')
+        try:
+            constants[name.strip()] = literal_eval(value.strip())
+        except (ValueError, SyntaxError):
+            parser.error('invalid constant definition %r' % define)
+    paths = compile_tree(
+        src, dest, jobs=opts.jobs,
+        force_mode=opts.force_mode,
+        autoescape_text=opts.autoescape_text,
+        buffered=opts.buffered,
+        inline_includes=opts.inline_includes,
+        constants=constants)
+    if not opts.quiet:
+        for path in paths:
+            print path
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
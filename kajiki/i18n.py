@@ -1,9 +1,8 @@
-from ir import TranslatableTextNode
-
 def gettext(s):
     return s
 
 def extract(fileobj, keywords, comment_tags, options):
+    from ir import TranslatableTextNode
     from xml_template import _Parser, _Compiler, expand
     text = fileobj.read()
     doc = _Parser('<string>', text).parse()
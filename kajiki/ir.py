@@ -1,8 +1,28 @@
+import re
+import ast
+from ast import literal_eval
+from copy import copy
+from collections import Counter
+try:
+    from hashlib import sha1
+except ImportError: # pragma no cover
+    from sha import new as sha1
+
 from util import gen_name, flattener
+from html_utils import HTML_EMPTY_ATTRS
+from template import escape, escape_attr
+
+def generate_python(ir, buffered=False):
+    '''Yield the PyLines for the template ir.  If buffered is true, the
+    generated functions append their output to a list and return the joined
+    text rather than yielding each chunk.
 
-def generate_python(ir):
+    Nodes yield the nodes of their body wrapped in flatteners rather than
+    iterating them, so the whole tree is walked through the explicit stack of
+    a single flattener and the cost of a node does not depend on its depth.'''
     cur_indent = 0
     for node in flattener(ir):
+        node.buffered = buffered
         if isinstance(node, IndentNode):
             cur_indent += 4
         elif isinstance(node, DedentNode):
@@ -11,14 +31,26 @@ def generate_python(ir):
             yield line.indent(cur_indent)
 
 class Node(object):
+    # Templates are compiled into many small nodes, so none of them has an
+    # instance dict
+    __slots__ = ('filename', 'lineno', 'buffered')
+    # The runtime helpers (keys of HELPERS) used by the code of the node
+    helpers = ()
 
     def __init__(self):
         self.filename = '<string>'
         self.lineno = 0
+        self.buffered = False
 
     def py(self): # pragma no cover
         return []
 
+    def output(self, expr):
+        '''Return the statement which emits the value of expr'''
+        if self.buffered:
+            return '_kj_append(%s)' % expr
+        return 'yield %s' % expr
+
     def __iter__(self):
         yield self
 
@@ -26,35 +58,146 @@ class Node(object):
         return PyLine(self.filename, self.lineno, text)
 
 class HierNode(Node):
+    __slots__ = ('body',)
 
     def __init__(self, body):
         super(HierNode, self).__init__()
         self.body = tuple(x for x in body if x is not None)
 
     def body_iter(self):
-        for x in optimize(flattener(map(flattener, self.body))):
-            yield x
+        for x in optimize(coalesce(self.body)):
+            yield flattener(x)
 
     def __iter__(self):
         yield self
         yield IndentNode()
-        for x in self.body_iter(): yield x
+        for x in _non_empty(self.body_iter()): yield x
         yield DedentNode()
 
-class IndentNode(Node): pass
-class DedentNode(Node): pass
+class IndentNode(Node): __slots__ = ()
+class DedentNode(Node): __slots__ = ()
+
+class BufferHead(Node):
+    '''Creates the output buffer at the top of a buffered function'''
+    __slots__ = ()
+
+    def py(self):
+        if self.buffered:
+            yield self.line('_kj_buf = []')
+            yield self.line('_kj_append = _kj_buf.append')
+
+class HelpersHead(Node):
+    '''Binds the runtime helpers used by the code of a function to locals
+    at its top, which saves their lookup wherever they are used, and defines
+    the functions hoisted out of its loops (see _hoist) after them'''
+    # bindings is set by py()
+    __slots__ = ('func', 'bindings')
+
+    def __init__(self, func):
+        super(HelpersHead, self).__init__()
+        self.func = func
+
+    def __iter__(self):
+        yield self
+        # The names bound in the function are only known once the code of
+        # the head has been generated
+        for x in _hoist(self.func, self.bindings): yield x
+
+    def py(self):
+        # Nested functions use the helpers bound by the functions they are
+        # nested in through their closure
+        bound = getattr(self.func, 'bound_helpers', frozenset())
+        names = set()
+        nested = []
+        for node in _walk_code(self.func):
+            node.buffered = self.buffered
+            names.update(node.helpers)
+            if isinstance(node, _FUNCTION_NODES):
+                nested.append(node)
+        for node in nested:
+            node.bound_helpers = bound.union(names)
+        self.bindings = _bindings(self.func)
+        _find_rebound(self.func, self.bindings)
+        for name in sorted(names.difference(bound)):
+            yield self.line('_kj_%s = %s' % (name, HELPERS[name]))
+
+class BufferTail(Node):
+    '''Returns the output buffer at the end of a buffered function'''
+    __slots__ = ('result',)
+
+    def __init__(self, result='__kj__.rendered.join(_kj_buf)'):
+        super(BufferTail, self).__init__()
+        self.result = result
+
+    def py(self):
+        if self.buffered:
+            yield self.line('return %s' % self.result)
 
 class TemplateNode(HierNode):
+    # constants holds the names of the constants defined by mod_py, which
+    # the template class applies over the context
+    __slots__ = ('mod_py', 'extends', 'constants')
 
     class TemplateTail(Node):
+        __slots__ = ()
         def py(self):
             yield self.line('template = kajiki.Template(template)')
 
+    class ExtendsDecl(Node):
+        __slots__ = ('tpl_name',)
+        def __init__(self, tpl_name):
+            super(TemplateNode.ExtendsDecl, self).__init__()
+            self.tpl_name = tpl_name
+        def py(self):
+            yield self.line('__extends__ = %r' % self.tpl_name)
+
+    class ConstantsDecl(Node):
+        __slots__ = ('names',)
+        def __init__(self, names):
+            super(TemplateNode.ConstantsDecl, self).__init__()
+            self.names = names
+        def py(self):
+            yield self.line('__constants__ = %r' % (self.names,))
+
     def __init__(self, mod_py=None, defs=None):
         super(TemplateNode, self).__init__(defs)
         if mod_py is None: mod_py = []
         if defs is None: defs = []
         self.mod_py = [ x for x in mod_py if x is not None ]
+        self.extends = self._static_extends()
+        self.constants = ()
+
+    def _static_extends(self):
+        '''Return the name of the parent template if the template always
+        extends the same one, i.e. its main function has a single extends
+        which is not nested in any other directive'''
+        for node in self.body:
+            if isinstance(node, DefNode) and node.decl == '__main__()':
+                break
+        else:
+            return None
+        extends = [ n for n in _walk(node) if isinstance(n, ExtendNode) ]
+        if len(extends) == 1 and extends[0] in node.body:
+            return extends[0].tpl_name
+        return None
+
+    def inline_body(self):
+        '''Return the body of the main function if the template can be
+        inlined where it is included, or None.  Only templates made of a
+        main function which neither binds nor reads any name qualify, as
+        the inlined body runs in the scope of the including template while
+        an included template gets an empty context.'''
+        if self.mod_py or self.extends is not None or len(self.body) != 1:
+            return None
+        main = self.body[0]
+        if not isinstance(main, DefNode) or main.decl != '__main__()':
+            return None
+        for node in _walk(main):
+            if node is main: continue
+            exprs = _expressions(node)
+            if exprs is None or [ e for e in exprs if not _reads_nothing(e) ]:
+                return None
+        return main.body
 
     def py(self):
         yield self.line('class template:')
@@ -62,11 +205,21 @@ class TemplateNode(HierNode):
     def __iter__(self):
         for x in flattener(self.mod_py):
             yield x
-        for x in super(TemplateNode, self).__iter__():
-            yield x
+        for node in _walk(self):
+            if isinstance(node, SwitchNode) and node.table is not None:
+                yield SwitchNode.Table(node)
+        yield self
+        yield IndentNode()
+        if self.extends is not None:
+            yield self.ExtendsDecl(self.extends)
+        if self.constants:
+            yield self.ConstantsDecl(self.constants)
+        for x in self.body_iter(): yield x
+        yield DedentNode()
         yield self.TemplateTail()
 
 class ImportNode(Node):
+    __slots__ = ('tpl_name', 'alias')
 
     def __init__(self, tpl_name, alias=None):
         super(ImportNode, self).__init__()
@@ -79,6 +232,7 @@ class ImportNode(Node):
                 self.tpl_name, self.alias))
 
 class IncludeNode(Node):
+    __slots__ = ('tpl_name',)
 
     def __init__(self, tpl_name):
         super(IncludeNode, self).__init__()
@@ -86,10 +240,11 @@ class IncludeNode(Node):
 
     def py(self):
         yield self.line(
-            'yield local.__kj__.import_(%r, None, {}).__main__()' % (
-                self.tpl_name))
+            self.output('local.__kj__.import_(%r, None, {}).__main__()' % (
+                self.tpl_name)))
 
 class ExtendNode(Node):
+    __slots__ = ('tpl_name',)
 
     def __init__(self, tpl_name):
         super(ExtendNode, self).__init__()
@@ -97,50 +252,149 @@ class ExtendNode(Node):
 
     def py(self):
         yield self.line(
-            'yield local.__kj__.extend(%r).__main__()' % (
-                self.tpl_name))
+            self.output('local.__kj__.extend(%r).__main__()' % (
+                self.tpl_name)))
 
 class DefNode(HierNode):
+    # bound_helpers is set by the HelpersHead of the enclosing function
+    __slots__ = ('decl', 'hoisted', 'bound_helpers')
     prefix = '@kajiki.expose'
 
     def __init__(self, decl, *body):
         super(DefNode, self).__init__(body)
         self.decl = decl
+        # Whether the function is defined at the top of the function it is
+        # nested in rather than where it appears
+        self.hoisted = False
 
     def py(self):
-        yield self.line(self.prefix)
+        if self.prefix:
+            yield self.line(self.prefix)
         yield self.line('def %s:' % (self.decl))
 
+    def define(self):
+        yield self
+        yield IndentNode()
+        yield BufferHead()
+        yield flattener(HelpersHead(self))
+        for x in _non_empty(self.body_iter()): yield x
+        yield BufferTail()
+        yield DedentNode()
+
+    def __iter__(self):
+        if not self.hoisted:
+            for x in self.define(): yield x
+
 class InnerDefNode(DefNode):
-    prefix='@__kj__.flattener.decorate'
+    __slots__ = ()
+
+    @property
+    def helpers(self):
+        if self.buffered: return ()
+        return ('decorate',)
+
+    @property
+    def prefix(self):
+        if self.buffered: return None
+        return '@_kj_decorate'
 
 class CallNode(HierNode):
 
     class CallTail(Node):
+        __slots__ = ('call',)
         def __init__(self, call):
             super(CallNode.CallTail, self).__init__()
             self.call = call
         def py(self):
-            yield self.line('yield ' + self.call) 
+            yield self.line(self.output(self.call))
+
+    __slots__ = ('decl', 'call', 'hoisted', 'bound_helpers')
 
     def __init__(self, caller, callee, *body):
         super(CallNode, self).__init__(body)
         fname = gen_name()
         self.decl = caller.replace('$caller', fname)
         self.call = callee.replace('$caller', fname)
+        self.hoisted = False
+
+    @property
+    def helpers(self):
+        if self.buffered: return ()
+        return ('decorate',)
 
     def py(self):
-        yield self.line('@__kj__.flattener.decorate')
+        if not self.buffered:
+            yield self.line('@_kj_decorate')
         yield self.line('def %s:' % (self.decl))
 
-    def __iter__(self):
+    def define(self):
         yield self
         yield IndentNode()
-        for x in self.body_iter(): yield x
+        yield BufferHead()
+        yield flattener(HelpersHead(self))
+        for x in _non_empty(self.body_iter()): yield x
+        yield BufferTail()
         yield DedentNode()
+
+    def __iter__(self):
+        if not self.hoisted:
+            for x in self.define(): yield x
         yield self.CallTail(self.call)
 
+class CacheNode(HierNode):
+    '''Renders its body once per key and reuses the text on later renders.
+    args is the argument list (key and optional ttl) of the fragment cache
+    lookup.'''
+
+    class CacheTail(Node):
+        __slots__ = ('p',)
+        def __init__(self, parent):
+            super(CacheNode.CacheTail, self).__init__()
+            self.p = parent
+        def py(self):
+            # Fragments are named after where they are defined and what
+            # they contain, so that the same key may be used by different
+            # fragments and edited fragments never get stale text
+            name = '%s:%d:%s' % (
+                self.p.filename, self.p.lineno, _digest(self.p)[:12])
+            yield self.p.line(self.output(
+                'local.__kj__.cached(%r, %s, %s)' % (
+                    name, self.p.fname, self.p.args)))
+
+    __slots__ = ('args', 'fname', 'hoisted', 'bound_helpers')
+
+    def __init__(self, args, *body):
+        super(CacheNode, self).__init__(body)
+        self.args = args
+        self.fname = gen_name()
+        self.hoisted = False
+
+    @property
+    def helpers(self):
+        if self.buffered: return ()
+        return ('decorate',)
+
+    def py(self):
+        if not self.buffered:
+            yield self.line('@_kj_decorate')
+        yield self.line('def %s():' % self.fname)
+
+    def define(self):
+        yield self
+        yield IndentNode()
+        yield BufferHead()
+        yield flattener(HelpersHead(self))
+        for x in _non_empty(self.body_iter()): yield x
+        yield BufferTail()
+        yield DedentNode()
+
+    def __iter__(self):
+        if not self.hoisted:
+            for x in self.define(): yield x
+        yield self.CacheTail(self)
+
 class ForNode(HierNode):
+    __slots__ = ('decl',)
 
     def __init__(self, decl, *body):
         super(ForNode, self).__init__(body)
@@ -150,64 +404,172 @@ class ForNode(HierNode):
         yield self.line('for %s:' % (self.decl))
 
 class WithNode(HierNode):
+    '''Binds the variables of vars (name=expr pairs separated by
+    semicolons) for the extent of its body.  The variables which may also be
+    bound by other code of the function are swapped with temporaries, which
+    restore them at the end; the others are simply assigned.'''
+    __slots__ = ('vars_text', 'vars', 'temps', 'rebound')
 
     class WithTail(Node):
-        def __init__(self, vars):
+        __slots__ = ('saved',)
+        def __init__(self, saved):
             super(WithNode.WithTail, self).__init__()
-            self.vars = vars
+            self.saved = saved
         def py(self):
-            gen = gen_name()
-            yield self.line('%s = local.__kj__.pop_with()' % gen)
-            for v in self.vars:
-                yield self.line('%s = %s.get(%r)' % (v, gen, v))
-                # yield self.line('if %s == (): del %s' % (v, v))
+            for name, temp in reversed(self.saved):
+                yield self.line('%s = %s' % (name, temp))
 
     def __init__(self, vars, *body):
         super(WithNode, self).__init__(body)
         self.vars_text = vars
-        self.vars = dict(var.split('=', 1)
-                         for var in vars.split(';'))
+        self.vars = [ tuple(x.strip() for x in var.split('=', 1))
+                      for var in vars.split(';') if var.strip() ]
+        self.temps = [ gen_name() for var in self.vars ]
+        # The names of vars which are bound elsewhere in the function, set
+        # by the HelpersHead of the function
+        self.rebound = ()
+
+    def _saved(self):
+        return [ (name, temp) for (name, expr), temp
+                 in zip(self.vars, self.temps) if name in self.rebound ]
 
     def py(self):
-        yield self.line(
-            'local.__kj__.push_with(locals(), %s)' % self.vars_text)
-        for k,v in self.vars.iteritems():
-            yield self.line('%s = %s' % (k,v))
-        
+        for (name, expr), temp in zip(self.vars, self.temps):
+            if name not in self.rebound:
+                yield self.line('%s = %s' % (name, expr))
+                continue
+            # The variable may not be bound yet, in which case it keeps
+            # the value of expr at the end
+            yield self.line('%s = %s' % (temp, expr))
+            yield self.line('try: %s, %s = %s, %s' % (temp, name, name, temp))
+            yield self.line('except NameError: %s = %s' % (name, temp))
+
     def __iter__(self):
         yield self
         for x in self.body_iter(): yield x
-        yield self.WithTail(self.vars)
-    
+        yield self.WithTail(self._saved())
 
 class SwitchNode(HierNode):
-
-    class SwitchTail(Node):
+    '''Renders the first case whose value equals the value of decl, or the
+    else branch if there is none.  The value is kept in a local which is
+    tested by a chain of if/elif statements or, when there are many cases
+    whose values are all constants, looked up in a dispatch table.'''
+    __slots__ = ('decl', 'var', 'table_items', 'table')
+
+    class Test(Node):
+        __slots__ = ('text',)
+        def __init__(self, node, text):
+            super(SwitchNode.Test, self).__init__()
+            self.filename = node.filename
+            self.lineno = node.lineno
+            self.text = text
+        def py(self):
+            yield self.line(self.text)
+
+    class Table(Node):
+        '''Defines the dispatch table of a switch at module level'''
+        __slots__ = ('switch',)
+        def __init__(self, switch):
+            super(SwitchNode.Table, self).__init__()
+            self.switch = switch
         def py(self):
-            yield self.line('local.__kj__.pop_switch()')
+            items = self.switch.table_items
+            yield self.line('%s = {%s}' % (self.switch.table, ', '.join(
+                        '%s: %d' % item for item in items)))
 
     def __init__(self, decl, *body):
         super(SwitchNode, self).__init__(body)
         self.decl = decl
+        self.var = gen_name()
+        self.table_items = self._table_items()
+        self.table = self.table_items and gen_name() or None
+
+    def _table_items(self):
+        # The (value, case index) items of the dispatch table, or None if
+        # the switch is tested by a chain of comparisons
+        cases = [ x for x in self.body if isinstance(x, CaseNode) ]
+        if len(cases) < DISPATCH_CASES: return None
+        rest = self.body[len(cases):]
+        if rest and (len(rest) > 1 or not isinstance(rest[0], ElseNode)):
+            return None
+        items, seen = [], []
+        for i, node in enumerate(cases):
+            try:
+                value = literal_eval(node.decl.strip())
+                hash(value)
+            except (ValueError, SyntaxError, TypeError):
+                return None
+            # Like the chain, the first of several equal cases wins
+            if value in seen: continue
+            seen.append(value)
+            items.append((node.decl.strip(), i))
+        return items
 
     def py(self):
-        yield self.line('local.__kj__.push_switch(%s)' % self.decl)
+        yield self.line('%s = %s' % (self.var, self.decl.strip()))
+        if self.table is None: return
+        # Cases come first, so the index of the else branch (or of nothing)
+        # is the number of cases.  An unhashable value matches no constant.
+        default = len([ x for x in self.body if isinstance(x, CaseNode) ])
+        yield self.line('try: %s = %s.get(%s, %d)' % (
+                self.var, self.table, self.var, default))
+        yield self.line('except TypeError: %s = %d' % (self.var, default))
 
     def __iter__(self):
         yield self
-        for x in self.body_iter(): yield x
-        yield self.SwitchTail()
+        if self.table is not None:
+            ncases = len([ x for x in self.body if isinstance(x, CaseNode) ])
+            for x in self._dispatch(0, ncases + 1): yield x
+            return
+        keyword = 'if'
+        for node in self.body:
+            if isinstance(node, CaseNode):
+                yield self.Test(node, '%s %s == (%s):' % (
+                        keyword, self.var, node.decl.strip()))
+                keyword = 'elif'
+                yield IndentNode()
+                for x in self._branch(node): yield x
+                yield DedentNode()
+            elif isinstance(node, ElseNode) and keyword == 'elif':
+                for x in node: yield x
+                keyword = 'if'
+            else:
+                # Anything else is rendered where it is and ends the chain
+                for x in coalesce([node]):
+                    yield flattener(x)
+                keyword = 'if'
+
+    def _branch(self, node):
+        for x in _non_empty(node.body_iter()): yield x
+
+    def _dispatch(self, lo, hi):
+        # Bisect the indices of the branches in [lo, hi)
+        if hi - lo == 1:
+            if lo < len(self.body):
+                for x in self._branch(self.body[lo]): yield x
+            else:
+                yield PassNode()
+            return
+        mid = (lo + hi) // 2
+        yield self.Test(self, 'if %s < %d:' % (self.var, mid))
+        yield IndentNode()
+        for x in self._dispatch(lo, mid): yield x
+        yield DedentNode()
+        yield self.Test(self, 'else:')
+        yield IndentNode()
+        for x in self._dispatch(mid, hi): yield x
+        yield DedentNode()
 
 class CaseNode(HierNode):
+    '''A branch of a SwitchNode, which generates its code'''
+    __slots__ = ('decl',)
 
     def __init__(self, decl, *body):
         super(CaseNode, self).__init__(body)
         self.decl = decl
 
-    def py(self):
-        yield self.line('if local.__kj__.case(%s):' % self.decl)
-
 class IfNode(HierNode):
+    __slots__ = ('decl',)
 
     def __init__(self, decl, *body):
         super(IfNode, self).__init__(body)
@@ -217,6 +579,7 @@ class IfNode(HierNode):
         yield self.line('if %s:' % self.decl)
 
 class ElseNode(HierNode):
+    __slots__ = ()
 
     def __init__(self,  *body):
         super(ElseNode, self).__init__(body)
@@ -225,6 +588,7 @@ class ElseNode(HierNode):
         yield self.line('else:')
 
 class TextNode(Node):
+    __slots__ = ('text', 'guard')
 
     def __init__(self, text, guard=None):
         super(TextNode, self).__init__()
@@ -232,88 +596,268 @@ class TextNode(Node):
         self.guard = guard
 
     def py(self):
-        s = 'yield %r' % self.text
+        s = self.output(repr(self.text))
         if self.guard:
             yield self.line('if %s: %s' % (self.guard, s))
         else:
             yield self.line(s)
 
 class TranslatableTextNode(TextNode):
+    __slots__ = ()
+
+    @property
+    def helpers(self):
+        if self.text.strip(): return ('gettext',)
+        return ()
 
     def py(self):
         text = self.text.strip()
         if text:
-            s = 'yield local.__kj__.gettext(%r)' % self.text
+            s = self.output('_kj_gettext(%r)' % self.text)
         else:
-            s = 'yield %r' % self.text
+            s = self.output(repr(self.text))
         if self.guard:
             yield self.line('if %s: %s' % (self.guard, s))
         else:
             yield self.line(s)
 
 class ExprNode(Node):
+    __slots__ = ('text', 'safe')
 
     def __init__(self, text, safe=False):
         super(ExprNode, self).__init__()
         self.text = text
         self.safe = safe
 
+    @property
+    def helpers(self):
+        if self.safe: return ()
+        return ('escape',)
+
     def py(self):
         if self.safe:
-            yield self.line('yield %s' % self.text)
+            yield self.line(self.output(self.text))
         else:
-            yield self.line('yield self.__kj__.escape(%s)' % self.text)
+            yield self.line(
+                self.output('_kj_escape(%s)' % self.text))
+
+class ChunkNode(Node):
+    '''Emits the text of a run of TextNodes and ExprNodes as a single chunk.
+    Adjacent text is joined at compile time; None values are left out and
+    nested flatteners are rendered when the chunk is joined.'''
+    __slots__ = ('parts',)
+
+    def __init__(self, parts):
+        super(ChunkNode, self).__init__()
+        self.parts = parts
+        self.filename = parts[0].filename
+        self.lineno = parts[0].lineno
+
+    @property
+    def helpers(self):
+        result = set()
+        for node in self.parts:
+            result.update(node.helpers)
+        if not self.buffered:
+            result.add('join')
+        return tuple(sorted(result))
+
+    def _items(self):
+        # The parts as a list of [constant, text or expression, lineno]
+        items = []
+        for node in self.parts:
+            if isinstance(node, AttrNode):
+                for const, x in node.chunk_parts():
+                    if const and items and items[-1][0]:
+                        items[-1][1] += x
+                    else:
+                        items.append([const, x, node.lineno])
+            elif isinstance(node, ExprNode):
+                if node.safe:
+                    items.append([False, '(%s)' % node.text, node.lineno])
+                else:
+                    items.append([False, '_kj_escape(%s)' % node.text,
+                                  node.lineno])
+            elif node.helpers:
+                items.append([False, '_kj_gettext(%r)' % node.text,
+                              node.lineno])
+            elif items and items[-1][0]:
+                items[-1][1] += node.text
+            else:
+                items.append([True, node.text, node.lineno])
+        return items
+
+    def py(self):
+        items = self._items()
+        if len(items) == 1:
+            const, x, lineno = items[0]
+            yield self.line(self.output(const and repr(x) or x))
+            return
+        # Each template line of the chunk gets its own line of code, so
+        # that errors are reported where the failing expression is
+        lines = []
+        for const, x, lineno in items:
+            x = const and repr(x) or x
+            if lines and lines[-1][1] >= lineno:
+                lines[-1][0].append(x)
+            else:
+                lines.append(([x], lineno))
+        if self.buffered:
+            head = '_kj_buf.extend(('
+        else:
+            head = self.output('_kj_join((')
+        for i, (exprs, lineno) in enumerate(lines):
+            text = ', '.join(exprs)
+            if i == 0: text = head + text
+            if i == len(lines) - 1: text += '))'
+            else: text += ','
+            yield PyLine(self.filename, lineno, text, i and 4 or 0)
+
+class AssignNode(Node):
+    '''Assigns the value of expr to the local variable name'''
+    __slots__ = ('name', 'expr')
+
+    def __init__(self, name, expr):
+        super(AssignNode, self).__init__()
+        self.name = name
+        self.expr = expr
+
+    def py(self):
+        yield self.line('%s = %s' % (self.name, self.expr))
 
 class PassNode(Node):
+    __slots__ = ()
 
     def py(self):
-        yield self.line('yield ""')
+        yield self.line(self.output('""'))
 
 class AttrNode(HierNode):
-
-    class AttrTail(Node):
-        def __init__(self, parent):
-            super(AttrNode.AttrTail, self).__init__()
-            self.p = parent
-        def py(self):
-            gen = self.p.genname
-            x = gen_name()
-            yield self.line("%s = self.__kj__.collect(%s())" % (gen, gen))
-            yield self.line(
-                'for %s in self.__kj__.render_attrs({%r:%s}, %r):'
-                % (x, self.p.attr, gen, self.p.mode))
-            yield self.line('    yield %s' % x)
+    '''Renders the attribute attr, whose value is made of the TextNodes and
+    ExprNodes in value, by building its text in place.  The attribute is left
+    out if its value is made of expressions which are all None.'''
+    __slots__ = ('attr', 'guard', 'mode', 'genname')
 
     def __init__(self, attr, value, guard=None, mode='xml'):
         super(AttrNode, self).__init__(value)
         self.attr = attr
-        # self.value = value
         self.guard = guard
         self.mode = mode
-        self.attrname, self.genname = gen_name(), gen_name()
+        self.genname = gen_name()
+
+    @property
+    def helpers(self):
+        exprs = [ x for x in self.body if isinstance(x, ExprNode) ]
+        result = ()
+        if [ x for x in exprs if not x.safe ]:
+            result += ('escape_attr',)
+        if len(exprs) > 1 and len(exprs) == len(self.body):
+            result += ('collect',)
+        return result
 
     def py(self):
-        yield self.line('def %s():' % self.genname)
-
-    def __iter__(self):
+        lines = list(self._py())
         if self.guard:
-            new_body = IfNode(
-                self.guard,
-                AttrNode(self.attr, value=self.body, mode=self.mode))
-            for x in new_body:
-                yield x
+            yield self.line('if %s:' % self.guard)
+            for l in lines:
+                yield l.indent()
         else:
-            yield self
-            yield IndentNode()
-            if self.body:
-                for part in self.body_iter():
-                    yield part
+            for l in lines: yield l
+
+    def _value(self):
+        # The value as a list of (constant, escaped text or expression)
+        # parts, and the list of its expressions
+        parts = []
+        exprs = []
+        for node in self.body:
+            if isinstance(node, ExprNode):
+                exprs.append(node.text)
+                if node.safe:
+                    parts.append((False, '(%s)' % node.text))
+                else:
+                    parts.append(
+                        (False, '_kj_escape_attr(%s)' % node.text))
+            elif parts and parts[-1][0]:
+                parts[-1] = (True, parts[-1][1] + escape_attr(node.text))
+            else:
+                parts.append((True, escape_attr(node.text)))
+        return parts, exprs
+
+    def chunk_parts(self):
+        '''Return the text of the attribute as a list of (constant, text or
+        expression) parts whose values are never None, or None if whether
+        the attribute is left out depends on its expressions'''
+        parts, exprs = self._value()
+        has_text = len(parts) > len(exprs)
+        if self.mode.startswith('html') and self.attr in HTML_EMPTY_ATTRS:
+            # Rendered as a bare name unless its value is None
+            if has_text or not exprs:
+                return [ (True, u' ' + self.attr.lower()) ]
+            return None
+        if not exprs:
+            text = u''.join(text for const, text in parts)
+            return [ (True, static_attr(self.attr, text, self.mode,
+                                        escaped=True)) ]
+        if not has_text:
+            return None
+        # The constant text is never None
+        result = [ (True, u' %s="' % self.attr) ]
+        for const, x in parts:
+            if const: result.append((True, x))
+            else: result.append((False, "%s or u''" % x))
+        result.append((True, u'"'))
+        return result
+
+    def _py(self):
+        parts = self.chunk_parts()
+        if parts is not None:
+            # Join the adjacent constants
+            joined = []
+            for const, x in parts:
+                if const and joined and joined[-1][0]:
+                    joined[-1] = (True, joined[-1][1] + x)
+                else:
+                    joined.append((const, x))
+            if len(joined) == 1:
+                yield self.line(self.output(repr(joined[0][1])))
             else:
-                yield TextNode('')
-            yield DedentNode()
-            yield self.AttrTail(self)
+                yield self.line(self.output("u''.join((%s))" % ', '.join(
+                            const and repr(x) or x for const, x in joined)))
+            return
+        parts, exprs = self._value()
+        if self.mode.startswith('html') and self.attr in HTML_EMPTY_ATTRS:
+            s = self.output(repr(u' ' + self.attr.lower()))
+            if len(exprs) == 1:
+                yield self.line('if (%s) is not None: %s' % (exprs[0], s))
+            else:
+                yield self.line(
+                    'if _kj_collect((%s,)) is not None: %s' % (
+                        ', '.join(exprs), s))
+            return
+        # Left out when the expressions are all None
+        head, tail = u' %s="' % self.attr, u'"'
+        v = self.genname
+        if len(parts) == 1:
+            yield self.line('%s = %s' % (v, parts[0][1]))
+        else:
+            yield self.line('%s = _kj_collect((%s,))' % (
+                    v, ', '.join(x for const, x in parts)))
+        yield self.line('if %s is not None: %s' % (
+                v, self.output('%r + %s + %r' % (head, v, tail))))
+
+    def __iter__(self):
+        yield self
+
+def static_attr(attr, value, mode='xml', escaped=False):
+    '''Return the text of the attribute attr with the constant value'''
+    if mode.startswith('html') and attr in HTML_EMPTY_ATTRS:
+        return u' ' + attr.lower()
+    if not escaped:
+        value = escape_attr(value)
+    return u' %s="%s"' % (attr, value)
 
 class AttrsNode(Node):
+    __slots__ = ('attrs', 'guard', 'mode')
+    helpers = ('render_attrs',)
 
     def __init__(self, attrs, guard=None, mode='xml'):
         super(AttrsNode, self).__init__()
@@ -322,19 +866,17 @@ class AttrsNode(Node):
         self.mode = mode
 
     def py(self):
-        x = gen_name()
-        def _body():
-            yield self.line(
-                'for %s in self.__kj__.render_attrs(%s, %r):' % (x, self.attrs, self.mode))
-            yield self.line('    yield %s' % x)
+        line = self.line(self.output(
+            'u\'\'.join(_kj_render_attrs(%s, %r))' % (
+                self.attrs, self.mode)))
         if self.guard:
             yield self.line('if %s:' % self.guard)
-            for l in _body():
-                yield l.indent()
+            yield line.indent()
         else:
-            for l in _body(): yield l
+            yield line
 
 class PythonNode(Node):
+    __slots__ = ('module_level', 'lines')
 
     def __init__(self, *body):
         super(PythonNode, self).__init__()
@@ -364,23 +906,448 @@ class PythonNode(Node):
             assert line.startswith(prefix)
             yield line[len(prefix):]
 
-def optimize(iter_node):
-    last_node = None
-    for node in iter_node:
+# Matches the expressions which may call a function, such as a template
+# function returning a flattener
+_CALL = re.compile(r'[\w)\]]\s*\(')
+
+def coalesce(nodes):
+    '''Return the list of nodes with each run of unguarded TextNodes,
+    ExprNodes and AttrNodes which are never left out that contains an
+    ExprNode, AttrNode or translatable text replaced by a ChunkNode.  The
+    ExprNodes which may call a function end a run and are left on their
+    own: the body of a template function returned into a chunk would only
+    run once the whole chunk has been evaluated, after the expressions
+    following it.  The nodes themselves are left untouched.'''
+    result = []
+    run = []
+    for node in list(nodes) + [None]:
+        if type(node) == ExprNode and _CALL.search(node.text):
+            pass
+        elif ((type(node) in (TextNode, TranslatableTextNode)
+               and not node.guard) or type(node) == ExprNode
+              or (type(node) == AttrNode and not node.guard
+                  and node.chunk_parts() is not None)):
+            run.append(node)
+            continue
+        if len(run) > 1 and [ x for x in run if type(x) != TextNode ]:
+            result.append(ChunkNode(run))
+        else:
+            result.extend(run)
+        run = []
+        if node is not None:
+            result.append(node)
+    return result
+
+def optimize(nodes):
+    '''Yield the nodes which generate code, with each run of TextNodes
+    with the same guard joined into a new TextNode.  Hoisted functions are
+    left out, as they are defined elsewhere.  The nodes themselves are left
+    untouched.'''
+    run = []
+    for node in nodes:
         if type(node) == TextNode:
-            if (type(last_node) == TextNode
-                and last_node.guard == node.guard):
-                last_node.text += node.text
-            else:
-                if last_node is not None: yield last_node
-                last_node = node
+            if run and run[-1].guard != node.guard:
+                yield _join_text(run)
+                run = []
+            run.append(node)
+        elif isinstance(node, DefNode) and node.hoisted:
+            continue
+        else:
+            if run:
+                yield _join_text(run)
+                run = []
+            yield node
+    if run:
+        yield _join_text(run)
+
+def _join_text(nodes):
+    if len(nodes) == 1: return nodes[0]
+    result = copy(nodes[0])
+    result.text = ''.join(node.text for node in nodes)
+    return result
+
+def _expressions(node):
+    '''Return the Python expressions evaluated by node itself (not by the
+    nodes in its body), or None if node may also bind names'''
+    if isinstance(node, ExprNode):
+        return [ node.text ]
+    if isinstance(node, (TextNode, AttrNode)):
+        return [ node.guard ] if node.guard else []
+    if isinstance(node, AttrsNode):
+        return [ node.attrs ] + ([ node.guard ] if node.guard else [])
+    if isinstance(node, (IfNode, SwitchNode, CaseNode)):
+        return [ node.decl ]
+    if isinstance(node, CacheNode):
+        return [ node.args ]
+    if isinstance(node, (ElseNode, IncludeNode, PassNode)):
+        return []
+    return None
+
+# The names which the expressions of inlined templates may read
+_INLINE_NAMES = frozenset(['True', 'False', 'None'])
+
+def _reads_nothing(expr):
+    '''Return whether the Python expression expr uses no name other than
+    those in _INLINE_NAMES (an expression binding a name uses it too)'''
+    try:
+        tree = ast.parse(expr.strip(), mode='eval')
+    except SyntaxError:
+        return False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id not in _INLINE_NAMES:
+            return False
+    return True
+
+def inline_includes(node, include):
+    '''Replace the includes nested in node by the body of the included
+    template wherever include(name) returns an IR whose body can be
+    inlined'''
+    body = getattr(node, 'body', None)
+    if not body: return
+    new_body = []
+    for child in body:
+        if isinstance(child, IncludeNode):
+            tree = include(child.tpl_name)
+            inlined = tree is not None and tree.inline_body()
+            if inlined:
+                new_body.extend(inlined)
+                continue
         else:
-            if last_node is not None: yield last_node
-            last_node = node
-    if last_node is not None:
-        yield last_node
+            inline_includes(child, include)
+        new_body.append(child)
+    node.body = tuple(new_body)
+
+def optimize_ir(node, constants=None, passes=None):
+    '''Return the IR node rewritten by the optimization passes (PASSES by
+    default).  constants maps names to values which are known when the
+    template is compiled: they must be Python literals, are used by the
+    passes and are defined as globals of the template.  node itself is left
+    untouched; the nodes whose body changes are copied.'''
+    if passes is None: passes = PASSES
+    constants = _check_constants(constants)
+    result = _rewrite(node, passes, constants)
+    if constants and isinstance(result, TemplateNode):
+        if result is node: result = copy(node)
+        result.mod_py = [
+            AssignNode(name, repr(value))
+            for name, value in sorted(constants.iteritems()) ] + result.mod_py
+        result.constants = tuple(sorted(constants))
+    return result
+
+def _check_constants(constants):
+    result = {}
+    for name, value in (constants or {}).iteritems():
+        if (not isinstance(name, basestring)
+            or not re.match(r'[A-Za-z_]\w*$', name)):
+            raise ValueError('Invalid constant name %r' % (name,))
+        try:
+            literal = literal_eval(repr(value)) == value
+        except (ValueError, SyntaxError):
+            literal = False
+        if not literal:
+            raise ValueError(
+                'The value of the constant %s is not a literal: %r' % (
+                    name, value))
+        result[str(name)] = value
+    return result
+
+def _rewrite(node, passes, constants):
+    body = getattr(node, 'body', None)
+    if not body: return node
+    if constants and isinstance(node, _FUNCTION_NODES + (TemplateNode,)):
+        constants = _unbound(constants, node)
+    new_body = [ _rewrite(child, passes, constants) for child in body ]
+    for p in passes:
+        new_body = p(node, new_body, constants)
+    if len(new_body) == len(body) and not [
+        x for x, y in zip(new_body, body) if x is not y ]:
+        return node
+    node = copy(node)
+    node.body = tuple(new_body)
+    if isinstance(node, TemplateNode):
+        node.extends = node._static_extends()
+    return node
+
+def _unbound(constants, func):
+    '''Return the constants whose names are not bound by the code of the
+    function node (or module-level code of the TemplateNode) func'''
+    if isinstance(func, TemplateNode):
+        bindings = _Bindings([ (n, '\n'.join(n.lines))
+                               for n in flattener(func.mod_py)
+                               if isinstance(n, PythonNode) ])
+    else:
+        bindings = _bindings(func)
+    return dict((name, value) for name, value in constants.iteritems()
+                if not _bound_elsewhere(name, None, bindings))
+
+# The syntax allowed in the expressions evaluated at compile time: no calls,
+# comprehensions or lambdas, and no powers whose result may be huge
+_CONSTANT_SYNTAX = (
+    ast.Expression, ast.Num, ast.Str, ast.Name, ast.Load, ast.Tuple, ast.List,
+    ast.Dict, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.UAdd,
+    ast.USub, ast.Invert, ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div,
+    ast.FloorDiv, ast.Mod, ast.LShift, ast.RShift, ast.BitOr, ast.BitXor,
+    ast.BitAnd, ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt,
+    ast.GtE, ast.Is, ast.IsNot, ast.In, ast.NotIn, ast.IfExp, ast.Subscript,
+    ast.Index, ast.Slice, ast.Attribute)
+
+_BUILTIN_CONSTANTS = { 'True': True, 'False': False, 'None': None }
+
+_DOTTED_NAME = re.compile(r'([A-Za-z_]\w*)[\w.]*$')
+
+# Returned by constant_value for the expressions which are not constant
+UNKNOWN = object()
+
+def constant_value(expr, constants):
+    '''Return the value of the Python expression expr if it only depends on
+    literals and the names in constants, or UNKNOWN'''
+    expr = expr.strip()
+    namespace = dict(_BUILTIN_CONSTANTS, **constants)
+    # Most expressions are (dotted) names, which need not be parsed
+    match = _DOTTED_NAME.match(expr)
+    if match and match.group(1) not in namespace:
+        return UNKNOWN
+    try:
+        tree = ast.parse(expr, mode='eval')
+    except SyntaxError:
+        return UNKNOWN
+    for node in ast.walk(tree):
+        if not isinstance(node, _CONSTANT_SYNTAX):
+            return UNKNOWN
+        if isinstance(node, ast.Name) and node.id not in namespace:
+            return UNKNOWN
+    namespace['__builtins__'] = {}
+    try:
+        return eval(compile(tree, '<string>', 'eval'), namespace)
+    except Exception:
+        return UNKNOWN
+
+def fold_constants(parent, nodes, constants):
+    '''Replace the ExprNodes whose value is a constant string or number by
+    TextNodes, and leave out those whose value is None.  The text is escaped
+    with the built-in escape function, not the escaper of the template
+    class.'''
+    result = []
+    for node in nodes:
+        if type(node) == ExprNode:
+            node = _fold_expr(parent, node, constants)
+            if node is None: continue
+        result.append(node)
+    return result
+
+def _fold_expr(parent, node, constants):
+    value = constant_value(node.text, constants)
+    in_attr = isinstance(parent, AttrNode)
+    if value is UNKNOWN:
+        return node
+    if value is None:
+        # An attribute made of expressions which are all None is left out
+        if in_attr: return node
+        return None
+    if not isinstance(value, (basestring, int, long, float)):
+        return node
+    try:
+        if in_attr:
+            # The attribute escapes its text itself
+            if node.safe: return node
+            text = unicode(value)
+        elif node.safe:
+            text = unicode(value)
+        else:
+            text = escape(value)
+    except UnicodeError:
+        return node
+    result = TextNode(text)
+    result.filename, result.lineno = node.filename, node.lineno
+    return result
+
+def prune_branches(parent, nodes, constants):
+    '''Replace the IfNodes whose test is constant, and the ElseNodes
+    following them, by the body of the branch which is taken'''
+    result = []
+    taken = None
+    for node in nodes:
+        if type(node) == ElseNode and taken is not None:
+            if not taken: result.extend(node.body)
+            taken = None
+            continue
+        taken = None
+        if type(node) == IfNode:
+            value = constant_value(node.decl, constants)
+            if value is not UNKNOWN:
+                taken = bool(value)
+                if taken: result.extend(node.body)
+                continue
+        result.append(node)
+    return result
+
+# The passes applied by optimize_ir.  Each is called with a node and the list
+# of the (already rewritten) nodes of its body, and the constants which are
+# not rebound in that body, and returns the new list of nodes of the body.
+PASSES = [ fold_constants, prune_branches ]
+
+def _walk(node):
+    '''Yield node and all the nodes nested in its body, without generating
+    any code'''
+    stack = [ node ]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(getattr(node, 'body', ())))
+
+def _walk_code(func):
+    '''Yield the nodes whose code is part of the function node func, i.e.
+    the nodes nested in its body except those in nested functions (the
+    nested functions themselves are part of func)'''
+    stack = coalesce(getattr(func, 'body', ()))[::-1]
+    while stack:
+        node = stack.pop()
+        yield node
+        if not isinstance(node, _OPAQUE_NODES):
+            stack.extend(reversed(coalesce(getattr(node, 'body', ()))))
+
+def _bindings(func):
+    '''Return the _Bindings of the code of the function node func'''
+    result = [ (func, getattr(func, 'decl', '')) ]
+    for node in _walk_code(func):
+        if isinstance(node, WithNode):
+            result.extend((node, name) for name, expr in node.vars)
+        elif isinstance(node, (ForNode, InnerDefNode)):
+            result.append((node, node.decl))
+        elif isinstance(node, PythonNode):
+            result.append((node, '\n'.join(node.lines)))
+    return _Bindings(result)
+
+_WORD = re.compile(r'\w+')
+_PLAIN_NAME = re.compile(r'\w+\Z')
+
+class _Bindings(object):
+    '''The (node, text) pairs of the code of a function which may bind
+    names in it: the text contains the names bound by the node (and possibly
+    others).  The words of the texts are counted once, overall and by node,
+    so that finding whether a name is bound elsewhere takes constant time.'''
+    __slots__ = ('pairs', 'counts', 'node_counts')
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+        self.counts = Counter()
+        self.node_counts = {}
+        for node, text in pairs:
+            words = _WORD.findall(text)
+            self.counts.update(words)
+            self.node_counts.setdefault(node, Counter()).update(words)
+
+def _bound_elsewhere(name, node, bindings):
+    '''Return whether name may be bound by other code than node'''
+    if not _PLAIN_NAME.match(name):
+        # e.g. the targets of a tuple assignment
+        text = '\n'.join(t for n, t in bindings.pairs if n is not node)
+        return re.search(r'\b%s\b' % re.escape(name), text) is not None
+    own = bindings.node_counts.get(node)
+    return bindings.counts[name] > (own[name] if own else 0)
+
+def _find_rebound(func, bindings):
+    '''Set the rebound names of the WithNodes in the code of the function
+    node func, whose _Bindings are bindings: the variables of each which may
+    also be bound by the function itself or some other of its nodes'''
+    for node in _walk_code(func):
+        if not isinstance(node, WithNode): continue
+        names = [ name for name, expr in node.vars ]
+        node.rebound = [
+            name for name in names if names.count(name) > 1
+            or _bound_elsewhere(name, node, bindings) ]
+
+def _loop_functions(func):
+    '''Yield the function nodes nested in loops in the code of the
+    function node func'''
+    stack = [ (child, False) for child in reversed(func.body) ]
+    while stack:
+        node, in_loop = stack.pop()
+        if isinstance(node, _FUNCTION_NODES):
+            if in_loop: yield node
+        elif not isinstance(node, AttrNode):
+            in_loop = in_loop or isinstance(node, ForNode)
+            stack.extend(
+                (child, in_loop)
+                for child in reversed(getattr(node, 'body', ())))
+
+def _hoist(func, bindings):
+    '''Yield the nodes defining the functions nested in loops of the
+    function node func (whose _Bindings are bindings) which can be defined
+    once at its top rather than on each iteration, and mark them as hoisted.
+    As their free variables are looked up when they are called, this is the
+    case of every function with a unique name and without default argument
+    values.'''
+    for node in _loop_functions(func):
+        if isinstance(node, DefNode):
+            name, params = node.decl.split('(', 1)
+            if _bound_elsewhere(name.strip(), node, bindings): continue
+        elif isinstance(node, CallNode):
+            params = node.decl.split('(', 1)[1]
+        else:
+            params = ''
+        if '=' in params: continue
+        node.hoisted = True
+        yield flattener(node.define())
+
+def _non_empty(nodes):
+    '''Yield the nodes, or a PassNode if there are none'''
+    empty = True
+    for node in nodes:
+        empty = False
+        yield node
+    if empty:
+        yield PassNode()
+
+# The number of constant cases from which a switch is dispatched through a
+# table rather than tested by a chain of comparisons, which is as fast for
+# fewer cases
+DISPATCH_CASES = 12
+
+# The expressions which the helpers used by generated code are bound to
+HELPERS = dict(
+    escape='self.__kj__.escape',
+    escape_attr='self.__kj__.escape_attr',
+    render_attrs='self.__kj__.render_attrs',
+    collect='self.__kj__.collect',
+    gettext='local.__kj__.gettext',
+    join='self.__kj__.join',
+    decorate='__kj__.flattener.decorate')
+
+# The names made up by gen_name(), which differ between compilations
+_re_gen_name = re.compile(r'\b_kj__?\d*\b')
+# The node attributes which do not change the code generated
+_UNDIGESTED = ('body', 'filename', 'lineno', 'buffered', 'hoisted')
+
+def _digest(node):
+    '''Return a hex digest of the code generated for node, which does not
+    depend on where the node is or on the names made up by the compiler'''
+    h = sha1()
+    for n in _walk(node):
+        state = sorted((k, v) for k, v in _node_state(n)
+                       if k not in _UNDIGESTED)
+        h.update(n.__class__.__name__)
+        h.update(_re_gen_name.sub('', repr(state)))
+    return h.hexdigest()
+
+def _node_state(node):
+    '''Yield the (name, value) pairs of the attributes which are set on
+    node'''
+    for cls in type(node).__mro__:
+        for name in cls.__dict__.get('__slots__', ()):
+            try:
+                yield name, getattr(node, name)
+            except AttributeError:
+                pass
+
+# Nodes which compile to a function
+_FUNCTION_NODES = (DefNode, CallNode, CacheNode)
+# Nodes whose body is not (directly) part of the code of the function they
+# appear in
+_OPAQUE_NODES = _FUNCTION_NODES + (AttrNode,)
 
 class PyLine(object):
+    __slots__ = ('_filename', '_lineno', '_text', '_indent')
 
     def __init__(self, filename, lineno, text, indent=0):
         self._filename = filename
@@ -389,14 +1356,13 @@ class PyLine(object):
         self._indent = indent
 
     def indent(self, sz=4):
-        return PyLine(self._filename, self._lineno, self._text, self._indent + sz)
+        '''Indent the line by sz more spaces and return it.  Lines are
+        indented in place, as each one is generated for a single use.'''
+        self._indent += sz
+        return self
 
     def __str__(self):
         return (' ' * self._indent) + self._text
-        if self._lineno:
-            return (' ' * self._indent) + self._text + '\t# %s:%d' % (self._filename, self._lineno)
-        else:
-            return (' ' * self._indent) + self._text
 
     def __repr__(self):
         return '%s:%s %s' % (self._filename, self._lineno, self)
@@ -1,3 +1,5 @@
+from types import CodeType
+
 # Comment copied from Python/compile.c:
 #
 # All about a_lnotab.
@@ -89,3 +91,36 @@ def lnotab_numbers(lnotab, first_lineno=0):
         cur_line += line_delta
     if cur_line != last_line:        
         yield cur_byte, cur_line
+
+def annotate_code(code, filename, linenos):
+    """Return a copy of the code object code, and of the code objects nested
+    in it, whose filename is filename and whose line numbers are mapped
+    through the dict linenos.  Unmapped lines keep the number of the line
+    before them.  As lnotab cannot encode decreasing line numbers, a line
+    mapped below the one before it gets the same number."""
+    if isinstance(filename, unicode):
+        filename = filename.encode('utf-8')
+    consts = tuple(
+        annotate_code(c, filename, linenos) if type(c) is CodeType else c
+        for c in code.co_consts)
+    first_lineno = cur_line = linenos.get(code.co_firstlineno, 0)
+    pairs = []
+    for byte_off, line in lnotab_numbers(code.co_lnotab, code.co_firstlineno):
+        cur_line = max(cur_line, linenos.get(line, cur_line))
+        if pairs and pairs[-1][1] == cur_line: continue
+        pairs.append((byte_off, cur_line))
+    return CodeType(
+        code.co_argcount,
+        code.co_nlocals,
+        code.co_stacksize,
+        code.co_flags,
+        code.co_code,
+        consts,
+        code.co_names,
+        code.co_varnames,
+        filename,
+        code.co_name,
+        first_lineno,
+        pairs and lnotab_string(pairs, first_lineno) or '',
+        code.co_freevars,
+        code.co_cellvars)
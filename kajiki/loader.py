@@ -1,20 +1,49 @@
 import os
-import pkg_resources
+import imp
+try:
+    from hashlib import sha1
+except ImportError: # pragma no cover
+    from sha import new as sha1
+
+from template import merge_extends
 
 class Loader(object):
+    # The store of the fragments cached by py:cache in the templates loaded
+    # (kajiki.cache.default_fragment_cache if None)
+    fragment_cache = None
 
-    def __init__(self):
+    def __init__(self, resolve_extends=False):
         self.modules = {}
+        self.resolve_extends = resolve_extends
+        self._deps = {}
 
     def import_(self, name, *args, **kwargs):
         mod = self.modules.get(name)
-        if mod:
+        if mod and not self._stale(name):
             return mod
+        self._deps.pop(name, None)
         mod = self._load(name, *args, **kwargs)
         mod.loader = self
+        if self.resolve_extends and mod.__extends__ is not None:
+            mod = merge_extends(mod, self.depend(name, mod.__extends__))
+            mod.loader = self
         self.modules[name] = mod
         return mod
 
+    def depend(self, name, dep):
+        '''Import the template dep, recording that the template name must be
+        reloaded whenever dep is'''
+        mod = self.import_(dep)
+        self._deps.setdefault(name, []).append((dep, mod))
+        return mod
+
+    def _stale(self, name):
+        '''Return True if the template name must be reloaded'''
+        for dep, mod in self._deps.get(name, ()):
+            if self.import_(dep) is not mod:
+                return True
+        return False
+
     def default_alias_for(self, name):
         return os.path.splitext(os.path.basename(name))[0]
 
@@ -24,23 +53,41 @@ class Loader(object):
 
 class MockLoader(Loader):
 
-    def __init__(self, modules):
-        super(MockLoader, self).__init__()
-        self.modules.update(modules)
-        for v in self.modules.itervalues():
+    def __init__(self, modules, resolve_extends=False):
+        super(MockLoader, self).__init__(resolve_extends)
+        self._templates = dict(modules)
+        for name, v in modules.iteritems():
             v.loader = self
-            
+            # Templates extending others are merged when first imported
+            if not (resolve_extends and v.__extends__ is not None):
+                self.modules[name] = v
+
+    def _load(self, name):
+        return self._templates[name]
+
 class FileLoader(Loader):
 
     def __init__(self, base, reload=True, force_mode=None,
-                 autoescape_text=False):
-        super(FileLoader, self).__init__()
+                 autoescape_text=False, buffered=False, cache_dir=None,
+                 resolve_extends=False, inline_includes=False,
+                 fragment_cache=None, constants=None):
+        super(FileLoader, self).__init__(resolve_extends)
         from kajiki import XMLTemplate, TextTemplate
+        from cache import CodeCache
         self.base = base
         self._timestamps = {}
         self._reload = reload
         self._force_mode = force_mode
         self._autoescape_text = autoescape_text
+        self._buffered = buffered
+        self._constants = constants
+        self.inline_includes = inline_includes
+        self._included = {}
+        self.fragment_cache = fragment_cache
+        if cache_dir is None:
+            self._cache = None
+        else:
+            self._cache = CodeCache(cache_dir)
         self.extension_map = dict(
             txt=lambda *a, **kw: TextTemplate(autoescape=self._autoescape_text, *a, **kw),
             xml=XMLTemplate,
@@ -50,19 +97,46 @@ class FileLoader(Loader):
     def _filename(self, name):
         return os.path.join(self.base, name)
 
-    def import_(self, name, *args, **kwargs):
-        filename = self._filename(name)
-        if self._reload and name in self.modules:
-            mtime = os.stat(filename).st_mtime
+    def _stale(self, name):
+        if self._reload:
+            mtime = os.stat(self._filename(name)).st_mtime
             if mtime > self._timestamps.get(name, 0):
-                del self.modules[name]
-        return super(FileLoader, self).import_(name, *args, **kwargs)
+                return True
+            for dep, mtime in self._included.get(name, {}).iteritems():
+                try:
+                    if os.stat(self._filename(dep)).st_mtime > mtime:
+                        return True
+                except (IOError, OSError):
+                    return True
+        return super(FileLoader, self)._stale(name)
 
     def _load(self, name, *args, **kwargs):
-        from kajiki import XMLTemplate, TextTemplate
         filename = self._filename(name)
         self._timestamps[name] = os.stat(filename).st_mtime
         source = open(filename, 'rb').read()
+        if self.inline_includes and 'include' not in kwargs:
+            kwargs['include'] = include = _Includes(self, name)
+            self._included[name] = include.timestamps
+        return self._compile(filename, source, *args, **kwargs)
+
+    def _load_ir(self, name, parents):
+        '''Return the IR of the template name (with its own includes
+        inlined) and the (name, digest) pairs of the templates it is made
+        of'''
+        filename = self._filename(name)
+        mtime = os.stat(filename).st_mtime
+        source = open(filename, 'rb').read()
+        include = _Includes(self, name, parents)
+        tree = self._compile(filename, source, ir_only=True, include=include)
+        include.timestamps[name] = mtime
+        include.deps.append((name, sha1(source).hexdigest()))
+        return tree, include
+
+    def _compile(self, filename, source, *args, **kwargs):
+        from kajiki import XMLTemplate, TextTemplate
+        kwargs.setdefault('buffered', self._buffered)
+        kwargs.setdefault('cache', self._cache)
+        kwargs.setdefault('constants', self._constants)
         if self._force_mode == 'text':
             return TextTemplate(source=source, filename=filename,
                                 autoescape=self._autoescape_text, *args, **kwargs)
@@ -76,13 +150,65 @@ class FileLoader(Loader):
             ext = os.path.splitext(filename)[1][1:]
             return self.extension_map[ext](
                 source=source, filename=filename, *args, **kwargs)
-        
+
+class _Includes(object):
+    '''Resolves the includes of the template name for the compiler, which
+    inlines the included templates it can.  parents are the names of the
+    templates being compiled which (indirectly) include this one.'''
+
+    def __init__(self, loader, name, parents=()):
+        self.loader = loader
+        self.name = name
+        self.parents = parents + (name,)
+        # The (name, digest) pairs of the templates resolved so far, which
+        # are stored along with the compiled code in the code cache
+        self.deps = []
+        # The modification times of the templates resolved so far, which
+        # tell the loader when to recompile the includer
+        self.timestamps = {}
+
+    def __call__(self, tpl_name):
+        '''Return the IR of the template tpl_name, or None if it must be
+        included at runtime'''
+        # Recursive includes are left to the runtime
+        if tpl_name in self.parents: return None
+        try:
+            tree, include = self.loader._load_ir(tpl_name, self.parents)
+        except (IOError, OSError):
+            return None
+        self.deps.extend(include.deps)
+        self.timestamps.update(include.timestamps)
+        return tree
+
+    def valid(self, deps):
+        '''Return True if none of the templates in the (name, digest) pairs
+        deps changed since they were resolved'''
+        for tpl_name, digest in deps:
+            filename = self.loader._filename(tpl_name)
+            try:
+                self.timestamps[tpl_name] = os.stat(filename).st_mtime
+                source = open(filename, 'rb').read()
+            except (IOError, OSError):
+                return False
+            if sha1(source).hexdigest() != digest:
+                return False
+        return True
+
 class PackageLoader(FileLoader):
 
-    def __init__(self, reload=True, force_mode=None):
-        super(PackageLoader, self).__init__(None, reload, force_mode)
+    def __init__(self, reload=True, force_mode=None, buffered=False,
+                 cache_dir=None, resolve_extends=False, inline_includes=False,
+                 fragment_cache=None, constants=None):
+        super(PackageLoader, self).__init__(None, reload, force_mode,
+                                            buffered=buffered,
+                                            cache_dir=cache_dir,
+                                            resolve_extends=resolve_extends,
+                                            inline_includes=inline_includes,
+                                            fragment_cache=fragment_cache,
+                                            constants=constants)
 
     def _filename(self, name):
+        import pkg_resources
         package, module = name.rsplit('.', 1)
         found = dict()
         for fn in pkg_resources.resource_listdir(package, '.'):
@@ -96,3 +222,30 @@ class PackageLoader(FileLoader):
         else:
             raise IOError, 'Unknown template %r' % name
 
+
+class PrecompiledLoader(Loader):
+    '''Loads templates compiled ahead of time by ``python -m kajiki.compile``.
+
+    Each template is imported from the module ``<base>/<name>.py`` (or just
+    the ``.pyc`` if the source module was not deployed), so no template is
+    ever parsed or compiled at runtime.'''
+
+    def __init__(self, base, resolve_extends=False):
+        super(PrecompiledLoader, self).__init__(resolve_extends)
+        self.base = base
+
+    def _filename(self, name):
+        return os.path.join(self.base, name) + '.py'
+
+    def _load(self, name):
+        filename = self._filename(name)
+        # Give every module a distinct name so that templates with the same
+        # basename in different directories do not replace each other
+        modname = 'kajiki_precompiled_' + sha1(filename).hexdigest()
+        if os.path.exists(filename):
+            module = imp.load_source(modname, filename)
+        elif os.path.exists(filename + 'c'):
+            module = imp.load_compiled(modname, filename + 'c')
+        else:
+            raise IOError, 'Unknown template %r' % name
+        return module.template
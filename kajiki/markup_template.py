@@ -7,6 +7,7 @@ DIRECTIVES=[
     ('if','test'),
     ('switch', 'test'),
     ('with', 'vars'),
+    ('cache', 'key'),
     ('replace', 'value'),
     ('block', 'name'),
     ('extends', 'href'),]
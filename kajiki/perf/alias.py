@@ -0,0 +1,42 @@
+# py:with benchmark
+#
+# Objective: Measure the cost of entering and leaving a py:with in a loop,
+# as when aliasing a deep attribute chain on each row of a table.
+#
+# The same table is rendered with the attribute chain repeated in each cell
+# and with the chain aliased by a py:with on each row.
+
+import sys
+import timeit
+
+import kajiki
+
+PLAIN = '''<table><tr py:for="row in rows"
+><td>${row.item.product.name}</td><td>${row.item.product.price}</td></tr
+></table>'''
+ALIASED = '''<table><tr py:for="row in rows" py:with="p=row.item.product"
+><td>${p.name}</td><td>${p.price}</td></tr></table>'''
+
+class Obj(object):
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+rows = [ Obj(item=Obj(product=Obj(name='p%d' % i, price=i)))
+         for i in range(1000) ]
+
+def run(number=20):
+    context = dict(rows=rows)
+    print '%-10s %18s %18s' % ('template', 'render ms', 'buffered ms')
+    for name, source in (('plain', PLAIN), ('aliased', ALIASED)):
+        result = []
+        for buffered in (False, True):
+            tpl = kajiki.XMLTemplate(source, buffered=buffered)
+            t = timeit.Timer(lambda: tpl(context).render())
+            result.append(1e3 * min(t.repeat(7, number)) / number)
+        print '%-10s %18.2f %18.2f' % ((name,) + tuple(result))
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        run(int(sys.argv[1]))
+    else:
+        run()
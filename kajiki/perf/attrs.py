@@ -0,0 +1,45 @@
+# Dynamic attribute benchmark
+#
+# Objective: Show how much it costs to render elements with dynamic
+# attributes, where every attribute value is computed for each row.
+#
+# A table with a dynamic class, id and href on each row is rendered with
+# an increasing number of rows, in both generator and buffered modes, and
+# so is a table whose rows only have static attributes.
+
+import sys
+import timeit
+
+import kajiki
+
+SOURCE = '''<table>
+<tr py:for="i, row in rows" class="${i % 2 and 'odd' or 'even'}" id="row-$i">
+<td><a href="/items/${row}?page=1">$row</a></td>
+</tr>
+</table>'''
+STATIC_SOURCE = '''<table class="items">
+<tr py:for="i, row in rows" class="row" data-kind="item">
+<td class="cell"><input type="checkbox" name="sel" class="select"/></td>
+<td class="cell"><a href="/items" class="link">$row</a></td>
+</tr>
+</table>'''
+
+def run(counts, number=5):
+    tpl = kajiki.XMLTemplate(SOURCE)
+    btpl = kajiki.XMLTemplate(SOURCE, buffered=True)
+    stpl = kajiki.XMLTemplate(STATIC_SOURCE)
+    print '%-8s %18s %18s %18s' % ('rows', 'render ms', 'buffered ms',
+                                   'static ms')
+    for count in counts:
+        context = dict(rows=list(enumerate(range(count))))
+        result = []
+        for t in (tpl, btpl, stpl):
+            timer = timeit.Timer(lambda: t(context).render())
+            result.append(1e3 * min(timer.repeat(3, number)) / number)
+        print '%-8d %18.2f %18.2f %18.2f' % ((count,) + tuple(result))
+
+if __name__ == '__main__':
+    counts = [ int(arg) for arg in sys.argv[1:] ]
+    if not counts:
+        counts = [100, 1000, 10000]
+    run(counts)
@@ -0,0 +1,45 @@
+# Big table benchmark
+#
+# Objective: Measure the per-expression cost of rendering, using the
+# kajiki templates of genshi_bench/bigtable.py without needing the other
+# template engines installed.
+#
+# A 1000 x 10 table is rendered from a list of dicts, with py:content on
+# each cell, and from nested py:for loops over ranges with text and
+# expressions in each cell (as in tables.html).
+
+import sys
+import timeit
+
+import kajiki
+
+BIGTABLE = '''<table>
+<tr py:for="row in table">
+<td py:for="c in row.values()" py:content="c"/>
+</tr>
+</table>'''
+CELLS = '''<table>
+<tr py:for="i in xrange(size)">
+<td py:for="j in xrange(size)">$i, $j</td>
+</tr>
+</table>'''
+
+table = [dict(a=1,b=2,c=3,d=4,e=5,f=6,g=7,h=8,i=9,j=10)
+          for x in range(1000)]
+
+def run(number=10):
+    context = dict(table=table, size=100)
+    print '%-10s %18s %18s' % ('template', 'render ms', 'buffered ms')
+    for name, source in (('bigtable', BIGTABLE), ('cells', CELLS)):
+        result = []
+        for buffered in (False, True):
+            tpl = kajiki.XMLTemplate(source, buffered=buffered)
+            t = timeit.Timer(lambda: tpl(context).render())
+            result.append(1e3 * min(t.repeat(7, number)) / number)
+        print '%-10s %18.2f %18.2f' % ((name,) + tuple(result))
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        run(int(sys.argv[1]))
+    else:
+        run()
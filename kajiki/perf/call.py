@@ -0,0 +1,41 @@
+# py:call benchmark
+#
+# Objective: Measure the cost of calling a macro with py:call in a loop, as
+# when rendering the fields of a form through a field macro.
+#
+# Each field is rendered by a py:call of the field() macro, whose caller
+# renders the input element of the field.
+
+import sys
+import timeit
+
+import kajiki
+
+SOURCE = '''<form
+><py:def function="field(caller, name, label)"
+><div class="field"><label for="$name">$label</label>${caller()}</div
+></py:def
+><py:def function="form(fields)"
+><py:for each="name, label, value in fields"
+><py:call function="field(%caller, name, label)"
+><input name="$name" value="$value"/></py:call
+></py:for></py:def
+>${form(fields)}</form>'''
+
+fields = [ ('f%d' % i, 'Field %d' % i, i) for i in range(200) ]
+
+def run(number=50):
+    context = dict(fields=fields)
+    print '%-10s %18s %18s' % ('template', 'render ms', 'buffered ms')
+    result = []
+    for buffered in (False, True):
+        tpl = kajiki.XMLTemplate(SOURCE, buffered=buffered)
+        t = timeit.Timer(lambda: tpl(context).render())
+        result.append(1e3 * min(t.repeat(7, number)) / number)
+    print '%-10s %18.2f %18.2f' % (('form',) + tuple(result))
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        run(int(sys.argv[1]))
+    else:
+        run()
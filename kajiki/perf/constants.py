@@ -0,0 +1,40 @@
+# Compile-time constants benchmark
+#
+# Objective: Measure what feature flags and settings cost when they are
+# looked up and tested each time a template is rendered, compared to giving
+# them to the compiler as constants.
+#
+# The same table, whose cells test a flag and print a setting, is rendered
+# with the values passed in the context and passed as constants.
+
+import sys
+import timeit
+
+import kajiki
+
+SOURCE = '''<table><tr py:for="i in rows"
+><td py:if="DEBUG">${i}</td><td py:else="">${CURRENCY}${i}</td
+><td py:if="SHOW_TAX and not DEBUG">${TAX}</td></tr></table>'''
+
+SETTINGS = dict(DEBUG=False, SHOW_TAX=True, CURRENCY='$', TAX='20%')
+
+def run(number=20):
+    rows = range(1000)
+    print '%-10s %18s %18s' % ('template', 'render ms', 'buffered ms')
+    for name, constants in (('context', None), ('constants', SETTINGS)):
+        context = dict(rows=rows)
+        if constants is None:
+            context.update(SETTINGS)
+        result = []
+        for buffered in (False, True):
+            tpl = kajiki.XMLTemplate(SOURCE, buffered=buffered,
+                                     constants=constants)
+            t = timeit.Timer(lambda: tpl(context).render())
+            result.append(1e3 * min(t.repeat(7, number)) / number)
+        print '%-10s %18.2f %18.2f' % ((name,) + tuple(result))
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        run(int(sys.argv[1]))
+    else:
+        run()
@@ -0,0 +1,58 @@
+# Template nesting benchmark
+#
+# Objective: Show that the cost of a chunk of output does not depend on how
+# many nested defs it is emitted through.
+#
+# Each template defines a chain of py:defs, level_0 ... level_<depth-1>,
+# where every level calls the next one and the innermost one emits the
+# chunks.  The time per chunk should stay flat as the depth grows.
+
+import sys
+import timeit
+
+import kajiki
+from kajiki import util
+
+CHUNKS = 2000
+
+def make_source(depth):
+    parts = [ '<div>' ]
+    parts.append(
+        '<py:def function="level_%d()"><py:for each="i in range(%d)"'
+        '>$i</py:for></py:def>' % (depth-1, CHUNKS))
+    for level in reversed(range(depth-1)):
+        parts.append('<py:def function="level_%d()">${level_%d()}</py:def>'
+                     % (level, level+1))
+    parts.append('${level_0()}</div>')
+    return ''.join(parts)
+
+def recursive_iter(self):
+    '''The flattener iteration used before the explicit stack, for reference'''
+    for x in self.iterator:
+        if type(x) == util.flattener:
+            for xx in x:
+                if xx is not None:
+                    yield xx
+        elif x is not None:
+            yield x
+
+def run(depths, number=10):
+    templates = [
+        (depth, kajiki.XMLTemplate(make_source(depth)))
+        for depth in depths ]
+    stack_iter = util.flattener.__iter__
+    print '%-8s %16s %16s' % ('depth', 'stack us/chunk', 'nested us/chunk')
+    for depth, tpl in templates:
+        result = []
+        for impl in (stack_iter, recursive_iter):
+            util.flattener.__iter__ = impl
+            t = timeit.Timer(lambda: tpl().render())
+            result.append(1e6 * t.timeit(number=number) / number / CHUNKS)
+        util.flattener.__iter__ = stack_iter
+        print '%-8d %16.3f %16.3f' % (depth, result[0], result[1])
+
+if __name__ == '__main__':
+    depths = [ int(arg) for arg in sys.argv[1:] ]
+    if not depths:
+        depths = [1, 2, 5, 10, 20, 30, 40, 50]
+    run(depths)
@@ -0,0 +1,59 @@
+# Escape benchmark
+#
+# Objective: Compare ways of escaping the values of expressions, which is
+# the most frequent operation when rendering a template.
+#
+# Each strategy escapes the same values: numbers, short and long text with
+# and without markup characters.  "translate" uses a unicode.translate
+# table, "regex" a regex search followed by replaces (the previous
+# implementation), "replace" membership tests followed by replaces (the
+# current kajiki.template.escape).
+
+import re
+import sys
+import timeit
+
+from kajiki.template import escape
+
+TABLE = { ord(u'&'): u'&amp;', ord(u'<'): u'&lt;', ord(u'>'): u'&gt;' }
+RE_ESCAPE = re.compile(r'&|<|>')
+
+def translate_escape(value):
+    return unicode(value).translate(TABLE)
+
+def regex_escape(value):
+    if value is None: return value
+    if hasattr(value, '__html__'):
+        return value.__html__()
+    uval = unicode(value)
+    if RE_ESCAPE.search(uval):
+        return uval.replace('&', '&amp;').replace(
+            '<', '&lt;').replace('>', '&gt;')
+    return uval
+
+VALUES = [
+    ('int', 42),
+    ('float', 3.25),
+    ('short', u'Hello, world'),
+    ('short <&>', u'Tom & Jerry <3'),
+    ('long', u'lorem ipsum dolor sit amet ' * 40),
+    ('long <&>', u'<b>bold</b> & more ' * 50) ]
+
+def run(number=20000):
+    strategies = [ ('translate', translate_escape),
+                   ('regex', regex_escape),
+                   ('replace', escape) ]
+    print '%-10s' % 'value' + ''.join(
+        '%14s' % ('%s us' % name) for name, f in strategies)
+    for name, value in VALUES:
+        result = []
+        for sname, f in strategies:
+            t = timeit.Timer(lambda: f(value))
+            result.append(1e6 * min(t.repeat(3, number)) / number)
+        print '%-10s' % name + ''.join('%14.3f' % x for x in result)
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        run(int(sys.argv[1]))
+    else:
+        run()
@@ -0,0 +1,60 @@
+# Template inheritance benchmark
+#
+# Objective: Show the cost of rendering a page which extends a layout chain
+# when py:extends is resolved at render time and when the loader merges the
+# chain into one template class (FileLoader(resolve_extends=True)).
+#
+# The page extends a site template, which extends the base layout; each
+# level overrides or adds a few defs and blocks.
+
+import os
+import shutil
+import tempfile
+import timeit
+
+import kajiki
+
+TEMPLATES = {
+    'base.html': '''<html><head><title>${title()}</title></head><body>
+<div py:def="nav()"><a href="/">Home</a></div>
+<py:def function="title()">Base</py:def>
+${nav()}
+<div py:block="content">No content</div>
+<div py:block="footer">Footer</div>
+</body></html>''',
+    'site.html': '''<py:extends href="base.html">
+<py:def function="title()">Site</py:def>
+<div py:block="footer">Site footer ${parent_block()}</div>
+<div py:def="nav()"><a href="/">Home</a> &gt; <a href="/s">Site</a></div>
+</py:extends>''',
+    'page.html': '''<py:extends href="site.html">
+<py:def function="title()">${name}'s page</py:def>
+<div py:block="content"><p py:for="i in range(5)">Item $i</p></div>
+</py:extends>''',
+    }
+
+def run(number=2000):
+    base = tempfile.mkdtemp()
+    try:
+        for name, text in TEMPLATES.items():
+            f = open(os.path.join(base, name), 'w')
+            f.write(text)
+            f.close()
+        context = dict(name='Rick')
+        results = []
+        for reload in (False, True):
+            for resolve in (False, True):
+                loader = kajiki.FileLoader(base, reload=reload,
+                                           resolve_extends=resolve)
+                def render():
+                    return loader.import_('page.html')(context).render()
+                results.append(render())
+                t = timeit.Timer(render)
+                print 'reload=%-6s resolve_extends=%-6s %8.2f us/render' % (
+                    reload, resolve, 1e6 * min(t.repeat(3, number)) / number)
+        assert len(set(results)) == 1
+    finally:
+        shutil.rmtree(base)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,49 @@
+# Fragment cache benchmark
+#
+# Objective: Show how much rendering a page is sped up by caching the
+# output of an expensive, rarely changing block with py:cache.
+#
+# The page renders a sidebar and a list of product cards; each product card
+# formats a number of attributes.  Both are rendered with and without
+# py:cache around them.
+
+import sys
+import timeit
+
+import kajiki
+
+PAGE = '''<html><body>
+<div class="sidebar" %(sidebar)s>
+  <ul><li py:for="c in categories"><a href="/c/${c}">${c.title()}</a></li></ul>
+</div>
+<div class="card" py:for="p in products" %(card)s>
+  <h2>${p['name']}</h2>
+  <dl><py:for each="k, v in sorted(p['attrs'].items())"><dt>$k</dt><dd>$v</dd></py:for></dl>
+</div>
+</body></html>'''
+
+def make_context(nproducts):
+    return dict(
+        categories=[ 'category%d' % i for i in range(20) ],
+        products=[ dict(id=i, name='Product %d' % i,
+                        attrs=dict(('attr%d' % j, j * i) for j in range(10)))
+                   for i in range(nproducts) ])
+
+def run(counts, number=100):
+    plain = kajiki.XMLTemplate(PAGE % dict(sidebar='', card=''))
+    cached = kajiki.XMLTemplate(PAGE % dict(
+            sidebar='py:cache="0"', card='py:cache="p[\'id\']"'))
+    print '%-8s %18s %18s' % ('products', 'plain us', 'cached us')
+    for count in counts:
+        context = make_context(count)
+        result = []
+        for tpl in (plain, cached):
+            t = timeit.Timer(lambda: tpl(context).render())
+            result.append(1e6 * min(t.repeat(3, number)) / number)
+        print '%-8d %18.2f %18.2f' % ((count,) + tuple(result))
+
+if __name__ == '__main__':
+    counts = [ int(arg) for arg in sys.argv[1:] ]
+    if not counts:
+        counts = [1, 10, 100]
+    run(counts)
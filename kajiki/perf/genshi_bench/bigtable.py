@@ -51,13 +51,15 @@ except ImportError:
 table = [dict(a=1,b=2,c=3,d=4,e=5,f=6,g=7,h=8,i=9,j=10)
           for x in range(1000)]
 
-kajiki_tmpl = kajiki.XMLTemplate(source="""
+kajiki_src = """
 <table>
 <tr py:for="row in table">
 <td py:for="c in row.values()" py:content="c"/>
 </tr>
 </table>
-""")
+"""
+kajiki_tmpl = kajiki.XMLTemplate(source=kajiki_src)
+kajiki_buffered_tmpl = kajiki.XMLTemplate(source=kajiki_src, buffered=True)
 
 genshi_tmpl = MarkupTemplate("""
 <table xmlns:py="http://genshi.edgewall.org/">
@@ -124,6 +126,10 @@ def test_kajiki():
     """Kajiki Template"""
     kajiki_tmpl(dict(table=table)).render()
 
+def test_kajiki_buffered():
+    """Kajiki Template (buffered)"""
+    kajiki_buffered_tmpl(dict(table=table)).render()
+
 def test_genshi():
     """Genshi template"""
     stream = genshi_tmpl.generate(table=table)
@@ -223,7 +229,7 @@ if neo_cgi:
 def run(which=None, number=10):
     tests = ['test_builder', 'test_genshi', 'test_genshi_text',
              'test_genshi_builder', 'test_mako', 'test_kid', 'test_kid_et',
-             'test_et', 'test_cet', 'test_clearsilver', 'test_django', 'test_kajiki', 'test_jinja2']
+             'test_et', 'test_cet', 'test_clearsilver', 'test_django', 'test_kajiki', 'test_kajiki_buffered', 'test_jinja2']
 
     if which:
         tests = filter(lambda n: n[5:] in which, tests)
@@ -0,0 +1,53 @@
+# Static include benchmark
+#
+# Objective: Show how much it costs to render a page made of static partials
+# (header, navigation, footer) included with py:include, and how much of it
+# is saved by inlining the partials when the page is compiled.
+#
+# The page includes each partial from inside a py:for loop, so that the
+# include overhead is paid several times per render.
+
+import os
+import sys
+import shutil
+import tempfile
+import timeit
+
+from kajiki import FileLoader
+
+PARTIALS = dict(
+    header='<div class="header"><h1>My Site</h1></div>',
+    nav='<ul class="nav"><li>Home</li><li>About</li><li>Contact</li></ul>',
+    footer='<div class="footer">Copyright ${2012}</div>')
+PAGE = '''<html><body>
+<div py:for="i in range(%d)">
+  <py:include href="header.html"/>
+  <py:include href="nav.html"/>
+  <p>Section $i</p>
+  <py:include href="footer.html"/>
+</div>
+</body></html>'''
+
+def run(counts, number=200):
+    base = tempfile.mkdtemp()
+    try:
+        print '%-8s %18s %18s' % ('count', 'include us', 'inlined us')
+        for count in counts:
+            for name, text in PARTIALS.items():
+                open(os.path.join(base, name + '.html'), 'w').write(text)
+            open(os.path.join(base, 'page.html'), 'w').write(PAGE % count)
+            result = []
+            for inline in (False, True):
+                loader = FileLoader(base, inline_includes=inline)
+                tpl = loader.import_('page.html')
+                t = timeit.Timer(lambda: tpl().render())
+                result.append(1e6 * min(t.repeat(3, number)) / number)
+            print '%-8d %18.2f %18.2f' % ((count,) + tuple(result))
+    finally:
+        shutil.rmtree(base)
+
+if __name__ == '__main__':
+    counts = [ int(arg) for arg in sys.argv[1:] ]
+    if not counts:
+        counts = [1, 10, 100]
+    run(counts)
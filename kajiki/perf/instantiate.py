@@ -0,0 +1,44 @@
+# Template instantiation benchmark
+#
+# Objective: Show how much it costs to instantiate and render a tiny
+# template, where the per-instance setup dominates the rendering itself.
+#
+# The one-line template is rendered with a small context, and so are
+# templates carrying an increasing number of (unused) py:defs, to show
+# how the setup cost grows with the size of the template class.
+
+import sys
+import timeit
+
+import kajiki
+
+SOURCE = '<span>Hello, $name!</span>'
+DEFS = '<py:def function="f%d(x)">$x</py:def>'
+
+def make_template(ndefs, buffered=False):
+    source = SOURCE
+    if ndefs:
+        source = '<span>%s Hello, $name!</span>' % ''.join(
+            DEFS % i for i in range(ndefs))
+    return kajiki.XMLTemplate(source, buffered=buffered)
+
+def run(ndefs_list, number=20000):
+    context = dict(name='world')
+    print '%-8s %18s %18s %18s' % (
+        'defs', 'init us', 'init+render us', 'buffered us')
+    for ndefs in ndefs_list:
+        tpl = make_template(ndefs)
+        btpl = make_template(ndefs, buffered=True)
+        result = []
+        for stmt in (lambda: tpl(context),
+                     lambda: tpl(context).render(),
+                     lambda: btpl(context).render()):
+            t = timeit.Timer(stmt)
+            result.append(1e6 * min(t.repeat(3, number)) / number)
+        print '%-8d %18.2f %18.2f %18.2f' % ((ndefs,) + tuple(result))
+
+if __name__ == '__main__':
+    ndefs_list = [ int(arg) for arg in sys.argv[1:] ]
+    if not ndefs_list:
+        ndefs_list = [0, 5, 20]
+    run(ndefs_list)
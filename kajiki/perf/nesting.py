@@ -0,0 +1,40 @@
+# Code generation nesting benchmark
+#
+# Objective: Show that the time taken to generate the code of a template is
+# linear in its number of nodes, however deeply they are nested.
+#
+# Each template is made of chains of depth nested py:ifs, each of which
+# holds some text and an expression, repeated so that every template has
+# about the same number of nodes.  The time per node should stay flat as the
+# depth grows.  Only the generation of the Python source from the IR is
+# timed: Python itself does not compile code nested 100 levels deep.
+
+import sys
+import timeit
+
+import kajiki
+from kajiki import ir
+
+NODES = 6000
+
+def make_source(depth):
+    chain = ''.join(
+        '<py:if test="x%d">level ${x%d}' % (level, level)
+        for level in range(depth)) + '</py:if>' * depth
+    return '<div>%s</div>' % (chain * max(1, NODES // (3 * depth)))
+
+def run(depths, number=3):
+    print '%-8s %10s %14s %14s' % ('depth', 'nodes', 'generate ms', 'us/node')
+    for depth in depths:
+        tree = kajiki.XMLTemplate(make_source(depth), ir_only=True)
+        nodes = len(list(ir._walk(tree)))
+        t = timeit.Timer(lambda: list(ir.generate_python(tree)))
+        elapsed = min(t.repeat(number, 1))
+        print '%-8d %10d %14.1f %14.2f' % (
+            depth, nodes, 1e3 * elapsed, 1e6 * elapsed / nodes)
+
+if __name__ == '__main__':
+    depths = [ int(arg) for arg in sys.argv[1:] ]
+    if not depths:
+        depths = [1, 10, 25, 50, 100]
+    run(depths)
@@ -0,0 +1,58 @@
+# Compile-time scaling benchmark
+#
+# Objective: Show how the time taken to compile a template grows with its
+# size, which should be linear.
+#
+# XML and text templates made of a repeated snippet holding a few braced
+# expressions are compiled at sizes from 1 KB to 1 MB (by default).
+
+import sys
+import time
+
+import kajiki
+
+XML_ROW = '''<tr py:if="row_%d"><td>${row.name}</td><td>${row.total + 1}</td
+><td>${"%%.2f" %% row.price}</td><td>${ {1: 'a'}.get(row.kind, '}') }</td></tr>
+'''
+TEXT_ROW = '''%%if row_%d
+${row.name}: ${row.total + 1} ${"%%.2f" %% row.price} ${ {1: 'a'}.get(row.kind, '}') }
+%%end
+'''
+
+def make_source(row, size, head='', tail=''):
+    rows = []
+    length = len(head) + len(tail)
+    i = 0
+    while length < size:
+        text = row % i
+        rows.append(text)
+        length += len(text)
+        i += 1
+    return head + ''.join(rows) + tail
+
+def timed(func, number=3):
+    best = None
+    for i in range(number):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best: best = elapsed
+    return best
+
+def run(sizes):
+    print '%-10s %14s %14s %14s %14s' % (
+        'size KB', 'xml ms', 'xml us/KB', 'text ms', 'text us/KB')
+    for kb in sizes:
+        xml = make_source(XML_ROW, kb * 1024, '<table>', '</table>')
+        text = make_source(TEXT_ROW, kb * 1024)
+        number = kb < 256 and 3 or 1
+        t_xml = timed(lambda: kajiki.XMLTemplate(xml), number)
+        t_text = timed(lambda: kajiki.TextTemplate(text), number)
+        print '%-10d %14.1f %14.1f %14.1f %14.1f' % (
+            kb, 1e3 * t_xml, 1e6 * t_xml / kb, 1e3 * t_text, 1e6 * t_text / kb)
+
+if __name__ == '__main__':
+    sizes = [ int(arg) for arg in sys.argv[1:] ]
+    if not sizes:
+        sizes = [1, 4, 16, 64, 256, 1024]
+    run(sizes)
@@ -0,0 +1,40 @@
+# Switch benchmark
+#
+# Objective: Measure the cost of py:switch inside a loop, as in a table of
+# status badges.
+#
+# Each of the rows renders a badge chosen by a py:switch over its status,
+# with 10 cases (tested in turn) and 20 cases (dispatched through a table).
+
+import sys
+import timeit
+
+import kajiki
+
+SOURCE = '''<ul><li py:for="status in statuses"><py:switch test="status"
+>%s<py:else>unknown</py:else></py:switch></li></ul>'''
+CASE = '<py:case value="%r"><b>s%d</b></py:case>'
+
+def make_template(ncases, buffered=False):
+    cases = ''.join(CASE % ('s%d' % i, i) for i in range(ncases))
+    return kajiki.XMLTemplate(SOURCE % cases, buffered=buffered)
+
+def run(nrows=1000, number=20):
+    print '%-8s %18s %18s' % ('cases', 'render ms', 'buffered ms')
+    for ncases in (10, 20):
+        # Statuses built at runtime, as read from a database
+        statuses = [ ''.join(['s', str(i % (ncases + 1))])
+                     for i in range(nrows) ]
+        context = dict(statuses=statuses)
+        result = []
+        for buffered in (False, True):
+            tpl = make_template(ncases, buffered)
+            t = timeit.Timer(lambda: tpl(context).render())
+            result.append(1e3 * min(t.repeat(7, number)) / number)
+        print '%-8d %18.2f %18.2f' % ((ncases,) + tuple(result))
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        run(int(sys.argv[1]))
+    else:
+        run()
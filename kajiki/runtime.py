@@ -0,0 +1,10 @@
+'''Everything needed to render compiled templates
+
+Importing this module (or loading templates with a PrecompiledLoader) never
+imports the template compilers, which keeps import time and memory down in
+processes which only render precompiled templates.
+'''
+from util import expose, flattener, literal, rendered
+from template import _Template, TplFunc, Template, from_globals
+from template import escape, escape_attr, Escaper
+from loader import Loader, PrecompiledLoader
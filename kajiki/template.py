@@ -1,115 +1,278 @@
-import re
-import types
-from cStringIO import StringIO
-from cgi import escape
-try:
-    from functools import update_wrapper
-except:
-    def update_wrapper(wrapper, wrapped,
-                       assigned = ('__module__', '__name__', '__doc__'),
-                       updated = ('__dict__',)):
-        for attr in assigned:
-            setattr(wrapper, attr, getattr(wrapped, attr))
-        for attr in updated:
-            getattr(wrapper, attr).update(getattr(wrapped, attr))
-        return wrapper
-
-from pprint import pprint
+from types import FunctionType
+from functools import partial
+from collections import namedtuple
 
 import kajiki
-from util import flattener, literal
+from util import flattener, literal, rendered, join_text
 from html_utils import HTML_EMPTY_ATTRS
-from ir import generate_python
 from kajiki import lnotab
 from kajiki import i18n
 
-re_escape = re.compile(r'&|<|>')
-escape_dict ={
-    '&':'&amp;',
-    '<':'&lt;',
-    '>':'&gt;'}
+CO_GENERATOR = 0x20 # from Include/code.h
 
-class _obj(object):
-    def __init__(self, **kw):
-        for k,v in kw.iteritems():
-            setattr(self,k,v)
+# The part of instance setup which is the same for every instance of a
+# template class, computed by _Template._prepare.  class_globals and escaper
+# are the base_globals and escaper of the class it was computed from; the
+# methods are bound by calling FunctionType on the items of codes,
+# func_names, defaults and closures, the last len(flatten_calls) of them
+# being wrapped to flatten their output.  constants maps the names of the
+# constants of the class to their values, which override the context.
+_Prepared = namedtuple('_Prepared', [
+        'class_globals', 'base_globals', 'names', 'codes', 'func_names',
+        'defaults', 'closures', 'flatten_calls', 'escaper', 'helpers',
+        'constants'])
+
+# The types whose text never needs escaping
+_PLAIN_TYPES = frozenset([int, long, float, bool])
+
+def escape(value):
+    '''Return value as text which is safe to include in markup.  None and
+    flatteners are passed through, objects with an __html__ method are
+    trusted to render themselves.'''
+    t = type(value)
+    if t is not unicode:
+        if t in _PLAIN_TYPES:
+            return unicode(value)
+        if value is None or t is flattener:
+            return value
+        html = getattr(value, '__html__', None)
+        if html is not None:
+            return html()
+        value = unicode(value)
+    # Each replace is a single pass in C, and the membership tests make
+    # the common case of text without markup characters even cheaper
+    if u'&' in value or u'<' in value or u'>' in value:
+        return value.replace(u'&', u'&amp;').replace(
+            u'<', u'&lt;').replace(u'>', u'&gt;')
+    return value
+
+def escape_attr(value):
+    '''Return value as text which is safe to include in a double quoted
+    attribute value, see escape()'''
+    t = type(value)
+    if t is not unicode:
+        if t in _PLAIN_TYPES:
+            return unicode(value)
+        if value is None or t is flattener:
+            return value
+        html = getattr(value, '__html__', None)
+        if html is not None:
+            return html()
+        value = unicode(value)
+    if u'&' in value or u'<' in value or u'>' in value or u'"' in value:
+        return value.replace(u'&', u'&amp;').replace(
+            u'<', u'&lt;').replace(u'>', u'&gt;').replace(u'"', u'&#34;')
+    return value
+
+class Escaper(object):
+    '''The escape engine used by the templates of a class, set as their
+    escaper attribute.  escape() is applied to the values of the expressions
+    in text and escape_attr() to those in attribute values.  Any object with
+    these two methods may be used instead.'''
+    escape = staticmethod(escape)
+    escape_attr = staticmethod(escape_attr)
+
+default_escaper = Escaper()
+
+class _Helpers(object):
+    '''The runtime support available to generated code as local.__kj__.
+    One instance is created per template instance; the stateless helpers
+    are shared by all of them and the stacks are only created when used.'''
+    __slots__ = ('_tpl', '_switch_stack', '_with_stack')
+
+    def __init__(self, tpl):
+        self._tpl = tpl
+
+    escape = staticmethod(escape)
+    escape_attr = staticmethod(escape_attr)
+    join = staticmethod(join_text)
+
+    @property
+    def gettext(self):
+        return i18n.gettext
+
+    def extend(self, parent):
+        return self._tpl._extend(parent)
+
+    def import_(self, name, alias, gbls):
+        return self._tpl._import(name, alias, gbls)
+
+    def cached(self, name, render, key, ttl=None):
+        '''Return the text of the fragment name for key from the template's
+        fragment cache, calling render() to produce it when missing'''
+        tpl = self._tpl
+        store = tpl.fragment_cache
+        if store is None and tpl.loader is not None:
+            store = tpl.loader.fragment_cache
+        if store is None:
+            from cache import default_fragment_cache as store
+        key = u'%s:%s' % (name, key)
+        text = store.get(key)
+        if text is None:
+            text = u''.join(tpl._chunks(render()))
+            store.set(key, text, ttl)
+        return text
+
+    # The switch and with stacks are no longer used by generated code, but
+    # are kept for templates precompiled by earlier releases
+    def push_switch(self, expr):
+        try:
+            self._switch_stack.append(expr)
+        except AttributeError:
+            self._switch_stack = [ expr ]
+
+    def pop_switch(self):
+        self._switch_stack.pop()
+
+    def case(self, obj):
+        return obj == self._switch_stack[-1]
+
+    def push_with(self, lcls, **kw):
+        d = dict((k,lcls.get(k, ()))
+                 for k in kw)
+        try:
+            self._with_stack.append(d)
+        except AttributeError:
+            self._with_stack = [ d ]
+
+    def pop_with(self):
+        return self._with_stack.pop()
+
+    def render_attrs(self, attrs, mode):
+        if hasattr(attrs, 'items'):
+            attrs = attrs.items()
+        if attrs is not None:
+            for k,v in sorted(attrs):
+                if v is None: continue
+                if mode.startswith('html') and k in HTML_EMPTY_ATTRS: yield ' '+k.lower()
+                else: yield ' %s="%s"' % (k,self.escape_attr(v))
+
+    def collect(it):
+        result = []
+        for part in it:
+            if part is None: continue
+            result.append(part)
+        if result:
+            return u''.join(result)
+        else:
+            return None
+    collect = staticmethod(collect)
 
 class _Template(object):
     __methods__=()
+    __extends__ = None
+    __constants__ = ()
     loader = None
     base_globals = None
     filename = None
+    fragment_cache = None
+    escaper = default_escaper
 
     def __init__(self, context=None):
         if context is None: context = {}
+        prepared = _get_prepared(self.__class__)
         self._context = context
-        base_globals = self.base_globals or {}
-        self.__globals__ = dict(
-            base_globals,
-            local=self,
-            self=self,
+        self.__globals__ = gbls = prepared.base_globals.copy()
+        gbls['local'] = gbls['self'] = self
+        # Bind every method to the instance globals in bulk; generator
+        # methods (which come last) are wrapped to flatten their output
+        codes = prepared.codes
+        funcs = map(FunctionType, codes, [ gbls ] * len(codes),
+                    prepared.func_names, prepared.defaults, prepared.closures)
+        flatten_calls = prepared.flatten_calls
+        if flatten_calls:
+            ngen = len(flatten_calls)
+            funcs[-ngen:] = map(partial, flatten_calls, funcs[-ngen:])
+        methods = zip(prepared.names, funcs)
+        self.__dict__.update(methods)
+        gbls.update(methods)
+        self.__kj__ = prepared.helpers(self)
+        gbls.update(context)
+        if prepared.constants:
+            gbls.update(prepared.constants)
+
+    @classmethod
+    def _prepare(cls):
+        '''Precompute the part of instance setup which is the same for every
+        instance of the class: the class globals, the recipe used to bind
+        the methods and the runtime helpers using the class's escaper.'''
+        base_globals = dict(
+            cls.base_globals or {},
             literal=literal,
             __builtins__=__builtins__,
             __kj__=kajiki)
-        for k,v in self.__methods__:
-            v = v.bind_instance(self)
-            setattr(self, k, v)
-            self.__globals__[k] = v
-        self.__kj__ = _obj(
-            extend=self._extend,
-            push_switch=self._push_switch,
-            pop_switch=self._pop_switch,
-            case=self._case,
-            import_=self._import,
-            escape=self._escape,
-            gettext=i18n.gettext,
-            render_attrs=self._render_attrs,
-            push_with=self._push_with,
-            pop_with=self._pop_with,
-            collect=self._collect)
-        self._switch_stack = []
-        self._with_stack = []
-        self.__globals__.update(context)
+        plain, gens = [], []
+        for name, meth in cls.__methods__:
+            func = meth._func
+            if func.func_code.co_flags & CO_GENERATOR:
+                gens.append((name, func))
+            else:
+                plain.append((name, func))
+        methods = plain + gens
+        escaper = cls.escaper
+        helpers = _Helpers
+        if escaper is not default_escaper:
+            helpers = type('_Helpers', (_Helpers,), dict(
+                    __slots__=(),
+                    escape=staticmethod(escaper.escape),
+                    escape_attr=staticmethod(escaper.escape_attr)))
+        # Remember which base_globals and escaper the recipe was built from
+        cls._prepared = prepared = _Prepared(
+            class_globals=cls.base_globals,
+            base_globals=base_globals,
+            names=tuple(name for name, func in methods),
+            codes=tuple(func.func_code for name, func in methods),
+            func_names=tuple(func.func_name for name, func in methods),
+            defaults=tuple(func.func_defaults for name, func in methods),
+            closures=tuple(func.func_closure for name, func in methods),
+            flatten_calls=(_flatten_call,) * len(gens),
+            escaper=escaper,
+            helpers=helpers,
+            constants=dict((name, base_globals[name])
+                           for name in cls.__constants__))
+        return prepared
 
     def __iter__(self):
-        for chunk in self.__main__():
-            yield unicode(chunk)
+        return self._chunks(self.__main__())
 
     def render(self):
-        return u''.join(self)
+        result = self.__main__()
+        if isinstance(result, rendered):
+            return unicode(result)
+        return u''.join(self._chunks(result))
 
-    def _push_with(self, lcls, **kw):
-        d = dict((k,lcls.get(k, ()))
-                 for k in kw)
-        self._with_stack.append(d)
-
-    def _pop_with(self):
-        return self._with_stack.pop()
+    def _chunks(self, result):
+        if isinstance(result, rendered):
+            yield unicode(result)
+            return
+        for chunk in result:
+            yield unicode(chunk)
 
     def _extend(self, parent):
+        p_inst = self.__dict__.get('_extended')
+        if p_inst is not None and parent == self.__extends__:
+            # Already wired up by a merged template class
+            return p_inst
         if isinstance(parent, basestring):
             parent = self.loader.import_(parent)
         p_inst = parent(self._context)
         p_globals = p_inst.__globals__
+        # The template functions visible to each instance: its own methods
+        # plus those received from its children
+        names = self.__dict__.get('_tpl_names') or self._prepared.names
+        p_names = p_inst._prepared.names
         # Find overrides
-        for k,v in self.__globals__.iteritems():
+        for k in names:
             if k == '__main__': continue
-            if not isinstance(v, TplFunc): continue
-            p_globals[k] = v
+            p_globals[k] = self.__globals__[k]
         # Find inherited funcs
-        for k, v in p_inst.__globals__.iteritems():
+        for k in p_names:
             if k == '__main__': continue
-            if not isinstance(v, TplFunc): continue
-            if k not in self.__globals__: 
-                self.__globals__[k] = v
+            if k not in self.__globals__:
+                self.__globals__[k] = p_globals[k]
             if not hasattr(self, k):
-                def _(k=k):
-                    '''Capture the 'k' variable in a closure'''
-                    def trampoline(*a, **kw):
-                        global parent
-                        return getattr(parent, k)(*a, **kw)
-                    return trampoline
-                setattr(self, k, TplFunc(_()).bind_instance(self))
+                setattr(self, k, _trampoline(self.__globals__, k))
+        p_inst._tpl_names = set(names).union(p_names)
         p_globals['child'] = self
         p_globals['local'] = p_inst
         p_globals['self'] = self.__globals__['self']
@@ -117,15 +280,6 @@ class _Template(object):
         self.__globals__['local'] = self
         return p_inst
 
-    def _push_switch(self, expr):
-        self._switch_stack.append(expr)
-
-    def _pop_switch(self):
-        self._switch_stack.pop()
-
-    def _case(self, obj):
-        return obj == self._switch_stack[-1]
-
     def _import(self, name, alias, gbls):
         tpl_cls = self.loader.import_(name)
         if alias is None:
@@ -133,41 +287,12 @@ class _Template(object):
         r = gbls[alias] = tpl_cls(gbls)
         return r
 
-    def _escape(self, value):
-        if value is None: return value
-        if hasattr(value, '__html__'):
-            return value.__html__()
-        if type(value) == flattener:
-            return value
-        uval = unicode(value)
-        if re_escape.search(uval):
-            return escape(uval)
-        else:
-            return uval
-
-    def _render_attrs(self, attrs, mode):
-        if hasattr(attrs, 'items'):
-            attrs = attrs.items()
-        if attrs is not None:        
-            for k,v in sorted(attrs):
-                if v is None: continue
-                if mode.startswith('html') and k in HTML_EMPTY_ATTRS: yield ' '+k.lower()
-                else: yield ' %s="%s"' % (k,self._escape(v))
-
-    def _collect(self, it):
-        result = []
-        for part in it:
-            if part is None: continue
-            result.append(part)
-        if result:
-            return u''.join(result)
-        else:
-            return None
-
     @classmethod
     def annotate_lnotab(cls, py_to_tpl):
         for name, meth in cls.__methods__:
             meth.annotate_lnotab(cls.filename, py_to_tpl, dict(py_to_tpl))
+        # The binding recipe refers to the old code objects
+        cls._prepared = None
 
     def defined(self, name):
         return name in self._context
@@ -179,97 +304,278 @@ def Template(ns):
         value = getattr(ns, name)
         if getattr(value, 'exposed', False):
             methods.append((name, TplFunc(value.im_func)))
+    dct['__extends__'] = getattr(ns, '__extends__', None)
+    dct['__constants__'] = getattr(ns, '__constants__', ())
     return type(ns.__name__,(_Template,), dct)
 
-def from_ir(ir_node):
-    py_lines = list(generate_python(ir_node))
+def merge_extends(child, parent):
+    '''Return a template class for child whose instances are created with
+    the whole chain of parent templates already instantiated and wired up,
+    as if __extends__ had been resolved at render time by _extend.  parent
+    is the class of child.__extends__, itself possibly merged.'''
+    chain = (child,) + parent.__dict__.get('_chain', (parent,))
+    merged = type(child.__name__, (child,), dict(
+            __init__=_init_merged,
+            _chain=chain))
+    merged._merged = _merge(chain, _chain_prepared(merged))
+    return merged
+
+# The part of the instance setup of a merged template class which is the
+# same for every instance, computed by _merge from the _Prepared of each
+# class of the chain (preps).  The parents are instances of level_classes.
+# The functions of all the levels are bound in one go: the function made of
+# codes[i] gets the globals of level code_levels[i], and the last ngen
+# functions are wrapped to flatten their output.  globals_table and
+# attrs_table hold, for each level, the names and function indices to put
+# into its globals and onto its instance.
+_Merged = namedtuple('_Merged', [
+        'preps', 'level_classes', 'code_levels', 'codes', 'func_names',
+        'defaults', 'closures', 'ngen', 'globals_table', 'attrs_table'])
+
+def _merge(chain, preps):
+    '''Compute the _Merged recipe of the classes of chain, whose _Prepared
+    setups are preps, by wiring up the names of their functions the way
+    _extend wires up their instances'''
+    plain, gens = [], []
+    gbls, attrs = [], []
+    for level, prep in enumerate(preps):
+        nplain = len(prep.codes) - len(prep.flatten_calls)
+        funcs = zip([level] * len(prep.codes), prep.codes, prep.func_names,
+                    prep.defaults, prep.closures)
+        plain.extend(zip(prep.names[:nplain], funcs[:nplain]))
+        gens.extend(zip(prep.names[nplain:], funcs[nplain:]))
+        gbls.append(dict.fromkeys(prep.base_globals))
+        attrs.append({})
+    for index, (name, func) in enumerate(plain + gens):
+        level = func[0]
+        gbls[level][name] = attrs[level][name] = index
+    names = set(preps[0].names)
+    for level, p_cls in enumerate(chain[1:]):
+        cls, prep, p_prep = chain[level], preps[level], preps[level + 1]
+        p_own = [ name for name in p_prep.names if name != '__main__' ]
+        # Find overrides
+        for k in names.difference(['__main__']):
+            gbls[level + 1][k] = gbls[level][k]
+        # Find inherited funcs
+        for k in p_own:
+            if k not in gbls[level]:
+                gbls[level][k] = gbls[level + 1][k]
+            if k not in prep.names and not hasattr(cls, k):
+                attrs[level][k] = attrs[level + 1][k]
+        names.update(p_own)
+    # The functions overridden in every level's globals can only be reached
+    # as attributes of their own instance: they are bound when first used
+    funcs = plain + gens
+    eager = set(v for dct in gbls for v in dct.itervalues() if v is not None)
+    eager.update(v for level, dct in enumerate(attrs)
+                 for v in dct.itervalues() if funcs[v][1][0] != level)
+    eager = sorted(eager)
+    renumber = dict((index, new) for new, index in enumerate(eager))
+    level_classes = list(chain)
+    for level, dct in enumerate(attrs):
+        later = dict(
+            (k, _BoundLater(k, funcs[v][1][1:], v >= len(plain)))
+            for k, v in dct.items() if v not in renumber)
+        if later:
+            level_classes[level] = type(
+                chain[level].__name__, (chain[level],), later)
+        for k in later:
+            del dct[k]
+    def table(dct):
+        items = sorted((k, renumber[v]) for k, v in dct.iteritems()
+                       if v is not None)
+        return (tuple(k for k, v in items), tuple(v for k, v in items))
+    code_levels, codes, func_names, defaults, closures = zip(
+        *[ funcs[index][1] for index in eager ])
+    return _Merged(
+        preps=preps,
+        level_classes=tuple(level_classes),
+        code_levels=code_levels,
+        codes=codes,
+        func_names=func_names,
+        defaults=defaults,
+        closures=closures,
+        ngen=len([ index for index in eager if index >= len(plain) ]),
+        globals_table=tuple(map(table, gbls)),
+        attrs_table=tuple(map(table, attrs)))
+
+def _init_merged(self, context=None):
+    if context is None: context = {}
+    cls = self.__class__
+    chain = cls._chain
+    # The recipe is computed again if any class of the chain changed
+    preps = _chain_prepared(cls)
+    merged = cls._merged
+    if merged.preps != preps:
+        merged = cls._merged = _merge(chain, preps)
+    # Only the child is constructed; its parents are bare instances whose
+    # state is filled in from the recipe
+    insts = [ self ] + [ p_cls.__new__(p_cls)
+                         for p_cls in merged.level_classes[1:] ]
+    gbls = [ prep.base_globals.copy() for prep in preps ]
+    codes = merged.codes
+    funcs = map(FunctionType, codes, [ gbls[l] for l in merged.code_levels ],
+                merged.func_names, merged.defaults, merged.closures)
+    if merged.ngen:
+        funcs[-merged.ngen:] = map(partial, (_flatten_call,) * merged.ngen,
+                                   funcs[-merged.ngen:])
+    get_func = funcs.__getitem__
+    for inst, prep, g, (g_names, g_funcs), (a_names, a_funcs) in zip(
+        insts, preps, gbls, merged.globals_table, merged.attrs_table):
+        g['local'] = g['self'] = inst
+        g.update(zip(g_names, map(get_func, g_funcs)))
+        g.update(context)
+        g.update(prep.constants)
+        dct = inst.__dict__
+        dct.update(zip(a_names, map(get_func, a_funcs)))
+        dct['_context'] = context
+        dct['__globals__'] = g
+        dct['__kj__'] = prep.helpers(inst)
+    for inst, p_inst in zip(insts, insts[1:]):
+        gbls, p_gbls = inst.__globals__, p_inst.__globals__
+        p_gbls['child'] = inst
+        p_gbls['local'] = p_inst
+        p_gbls['self'] = gbls['self']
+        gbls['parent'] = p_inst
+        gbls['local'] = inst
+        inst._extended = p_inst
+
+def _chain_prepared(cls):
+    '''Return the _Prepared instance setup of the merged template class cls
+    and of each of its parent classes'''
+    return (_get_prepared(cls),) + tuple(map(_get_prepared, cls._chain[1:]))
+
+def _get_prepared(cls):
+    '''Return the _Prepared instance setup of the template class cls,
+    computing it again if its globals or escaper changed'''
+    prepared = cls.__dict__.get('_prepared')
+    if (prepared is None or prepared.class_globals is not cls.base_globals
+        or prepared.escaper is not cls.escaper):
+        prepared = cls._prepare()
+    return prepared
+
+def from_ir(ir_node, buffered=False):
+    code, py_text, py_linenos = generate_code(ir_node, buffered)
+    return from_code(code, py_text, py_linenos, ir_node.filename)
+
+def from_source(source, filename, compile_ir, options=(), buffered=False,
+                cache=None, include=None):
+    '''Build the template class for source.  compile_ir() is called to get
+    the template's IR unless cache already holds the code compiled from the
+    same source with the same options.  include is the resolver compile_ir()
+    uses to inline other templates; a cached entry is only reused if
+    include.valid() finds none of the templates it inlined changed.'''
+    if include is not None:
+        options = options + ('include',)
+    if cache is None:
+        entry = generate_code(compile_ir(), buffered)
+    else:
+        # The code carries the filename of the template
+        key = cache.key(source, options, buffered, filename)
+        entry = cache.get(key)
+        if entry is not None:
+            entry, deps = entry[:3], entry[3]
+            if include is not None and not include.valid(deps):
+                entry = None
+        if entry is None:
+            entry = generate_code(compile_ir(), buffered)
+            deps = ()
+            if include is not None:
+                deps = tuple(include.deps)
+            cache.put(key, entry + (deps,))
+    return from_code(filename=filename, *entry)
+
+def generate_code(ir_node, buffered=False):
+    '''Return the module code object for the template ir, along with the
+    Python text it was compiled from and the (python line, template line)
+    pairs mapping one to the other.  The code objects already carry the
+    filename and line numbers of the template.'''
+    from ir import generate_python
+    py_lines = list(generate_python(ir_node, buffered))
     py_text = '\n'.join(map(str, py_lines))
     py_linenos = [ ]
-    last_lineno = 0
+    lineno = 0
     for i,l in enumerate(py_lines):
-        lno =max(last_lineno, l._lineno or 0)
-        py_linenos.append((i+1, lno))
-        last_lineno = lno
-    dct = dict(kajiki=kajiki)
+        # Lines which do not come from the template belong to the line
+        # before them
+        lineno = l._lineno or lineno
+        py_linenos.append((i+1, lineno))
     try:
-        exec py_text in dct
+        code = compile(py_text, '<string>', 'exec')
     except (SyntaxError, IndentationError), err: # pragma no cover
         for i, line in enumerate(py_text.splitlines()):
             print '%3d %s' % (i+1, line)
         raise
+    code = lnotab.annotate_code(code, ir_node.filename, dict(py_linenos))
+    return code, py_text, py_linenos
+
+def from_code(code, py_text, py_linenos, filename):
+    '''Build the template class from the module code object returned by
+    generate_code'''
+    dct = dict(kajiki=kajiki)
+    exec code in dct
+    return _finish(dct, py_text, py_linenos, filename)
+
+def from_globals(dct, py_text, py_linenos, filename):
+    '''Finish the template class defined by executing generated code in the
+    namespace dct.  The code was compiled from the generated text itself (as
+    precompiled modules are), so the functions of the class are annotated
+    with the template line numbers of py_linenos.'''
+    tpl = _finish(dct, py_text, py_linenos, filename)
+    tpl.annotate_lnotab(py_linenos)
+    return tpl
+
+def _finish(dct, py_text, py_linenos, filename):
     tpl = dct['template']
     tpl.base_globals = dct
     tpl.py_text = py_text
-    tpl.filename = ir_node.filename
-    tpl.annotate_lnotab(py_linenos)
+    tpl.py_linenos = py_linenos
+    tpl.filename = filename
     return tpl
 
-class TplFunc(object):
+def _flatten_call(func, *args, **kwargs):
+    return flattener(func(*args, **kwargs))
+
+class _BoundLater(object):
+    '''The method name of the parents of merged template instances, bound
+    to the instance's globals when first looked up.  func holds the code,
+    name, defaults and closure of the function, whose output is flattened
+    if flatten is true.'''
+    __slots__ = ('_name', '_func', '_flatten')
 
-    def __init__(self, func, inst=None):
+    def __init__(self, name, func, flatten):
+        self._name = name
         self._func = func
-        self._inst = inst
-        self._bound_func = None
+        self._flatten = flatten
 
-    def bind_instance(self, inst):
-        return TplFunc(self._func, inst)
+    def __get__(self, inst, cls):
+        if inst is None: return self
+        func = FunctionType(self._func[0], inst.__globals__, *self._func[1:])
+        if self._flatten:
+            func = partial(_flatten_call, func)
+        inst.__dict__[self._name] = func
+        return func
+
+def _trampoline(gbls, name):
+    '''Return a function calling the method name of the current parent
+    template of the instance whose globals are gbls'''
+    def trampoline(*a, **kw):
+        return getattr(gbls['parent'], name)(*a, **kw)
+    return trampoline
+
+class TplFunc(object):
+    '''A function exposed by a template class.  Each template instance gets
+    its own copy of the function, bound to the instance's globals.'''
+    __slots__ = ('_func',)
+
+    def __init__(self, func):
+        self._func = func
 
     def __repr__(self): # pragma no cover
-        if self._inst:
-            return '<bound tpl_function %r of %r>' % (
-                self._func.func_name, self._inst)
-        else:
-            return '<unbound tpl_function %r>' % (self._func.func_name)
-
-    def __call__(self, *args, **kwargs):
-        if self._bound_func is None:
-            self._bound_func = self._bind_globals(
-                self._inst.__globals__)
-        return self._bound_func(*args, **kwargs)
-
-    def _bind_globals(self, globals):
-        '''Return a function which has the globals dict set to 'globals' and which
-        flattens the result of self._func'.
-        '''
-        func = types.FunctionType(
-            self._func.func_code,
-            globals,
-            self._func.func_name,
-            self._func.func_defaults,
-            self._func.func_closure
-            )
-        return update_wrapper(
-            lambda *a,**kw:flattener(func(*a,**kw)),
-            func)
+        return '<tpl_function %r>' % (self._func.func_name)
 
     def annotate_lnotab(self, filename, py_to_tpl, py_to_tpl_dct):
         if not py_to_tpl: return
-        code = self._func.func_code
-        new_lnotab_numbers = []
-        for bc_off, py_lno in lnotab.lnotab_numbers(code.co_lnotab, code.co_firstlineno):
-            tpl_lno = py_to_tpl_dct.get(py_lno, None)
-            if tpl_lno is None:
-                print 'ERROR LOOKING UP LINE #%d' % py_lno
-                continue
-            new_lnotab_numbers.append((bc_off, tpl_lno))
-        if not new_lnotab_numbers: return
-        new_firstlineno = py_to_tpl_dct.get(code.co_firstlineno, 0)
-        new_lnotab = lnotab.lnotab_string(new_lnotab_numbers, new_firstlineno)
-        new_code = types.CodeType(
-            code.co_argcount,
-            code.co_nlocals,
-            code.co_stacksize,
-            code.co_flags,
-            code.co_code,
-            code.co_consts,
-            code.co_names,
-            code.co_varnames,
-            filename.encode('utf-8'),
-            code.co_name,
-            new_firstlineno,
-            new_lnotab,
-            code.co_freevars,
-            code.co_cellvars)
-        self._func.func_code = new_code
-        return
+        self._func.func_code = lnotab.annotate_code(
+            self._func.func_code, filename, py_to_tpl_dct)
 
@@ -94,6 +94,143 @@ class TestCall(TestCase):
             rsp == 'Quoth the raven, "Nevermore 0."\n'
             'Quoth the raven, "Nevermore 1."\n'), rsp
 
+    def test_helpers(self):
+        tpl = kajiki.template.from_ir(self.tpl)
+        # Each function binds the helpers it uses once; the caller uses
+        # those of __main__
+        lines = [ l.strip() for l in tpl.py_text.splitlines() ]
+        assert lines.count('_kj_escape = self.__kj__.escape') == 2, lines
+        assert lines.count('_kj_decorate = __kj__.flattener.decorate') == 1
+        assert "yield _kj_join(('Nevermore ', _kj_escape(n)))" in lines, lines
+
+class TestChunk(TestCase):
+
+    def setUp(self):
+        self.tpl = ir.TemplateNode(
+            defs=[ir.DefNode(
+                    '__main__()',
+                    ir.TextNode('a'),
+                    ir.ExprNode('None'),
+                    ir.ExprNode('"<"'),
+                    ir.ExprNode('1', safe=True),
+                    ir.TranslatableTextNode(' '),
+                    ir.ExprNode('None', safe=True),
+                    ir.ExprNode('b()'),
+                    ir.TextNode('c'))])
+
+    def test_basic(self):
+        for buffered in (False, True):
+            tpl = kajiki.template.from_ir(self.tpl, buffered)
+            b = lambda: kajiki.flattener(iter(['b', None]))
+            rsp = tpl(dict(b=b)).render()
+            assert rsp == 'a&lt;1 bc', rsp
+            # The text and expressions around the call are emitted at once
+            lines = [ l.strip() for l in tpl.py_text.splitlines() ]
+            assert len([ l for l in lines if l.startswith(
+                        ('yield', '_kj_buf.extend(', '_kj_append(')) ]) == 3, lines
+
+    def test_order(self):
+        # The body of a template function called in an expression runs
+        # before the expressions following it are evaluated
+        tpl = kajiki.XMLTemplate('''<div><py:def function="f()"
+>${log.append('f') or 'F'}</py:def>${f()}${log.append('x') or 'X'}</div>''')
+        log = []
+        rsp = tpl(dict(log=log)).render()
+        assert rsp == '<div>FX</div>', rsp
+        assert log == ['f', 'x'], log
+
+class TestGenerate(TestCase):
+
+    def test_text(self):
+        text = ir.TextNode('a')
+        tree = ir.TemplateNode(
+            defs=[ir.DefNode('__main__()', text, ir.TextNode('b'))])
+        # Joining the text leaves the IR untouched, so the same code is
+        # generated every time
+        for i in range(2):
+            tpl = kajiki.template.from_ir(tree)
+            rsp = tpl().render()
+            assert rsp == 'ab', rsp
+        assert text.text == 'a', text.text
+
+    def test_depth(self):
+        node = ir.TextNode('x')
+        for i in range(500):
+            node = ir.IfNode('True', node)
+        tree = ir.TemplateNode(defs=[ir.DefNode('__main__()', node)])
+        lines = [ str(l) for l in ir.generate_python(tree) ]
+        assert ' ' * 4 * 502 + "yield 'x'" in lines, lines[-3:]
+
+class TestOptimize(TestCase):
+
+    def setUp(self):
+        self.main = ir.DefNode(
+            '__main__()',
+            ir.IfNode(
+                'DEBUG',
+                ir.TextNode('debug')),
+            ir.ElseNode(
+                ir.ExprNode('"<%s>" % MODE'),
+                ir.ExprNode('None')),
+            ir.IfNode(
+                'not DEBUG and name',
+                ir.ExprNode('name')),
+            ir.AttrNode('title', [ ir.ExprNode('MODE'),
+                                   ir.ExprNode('None') ]))
+        self.tpl = ir.TemplateNode(defs=[self.main])
+
+    def test_constants(self):
+        tree = ir.optimize_ir(self.tpl, dict(DEBUG=False, MODE='<b>'))
+        # The IR itself is left untouched
+        assert len(self.main.body) == 4, self.main.body
+        assert tree is not self.tpl
+        tpl = kajiki.template.from_ir(tree)
+        rsp = tpl(dict(name='Rick')).render()
+        assert rsp == '&lt;&lt;b&gt;&gt;Rick title="&lt;b&gt;"', rsp
+        lines = [ l.strip() for l in tpl.py_text.splitlines() ]
+        assert 'if DEBUG:' not in lines, lines
+        assert 'if not DEBUG and name:' in lines, lines
+        # The constants are globals of the template
+        assert "MODE = '<b>'" in lines, lines
+
+    def test_literals(self):
+        tree = ir.optimize_ir(self.tpl)
+        lines = [ l.strip() for l in kajiki.template.from_ir(tree).py_text
+                  .splitlines() ]
+        assert 'if DEBUG:' in lines, lines
+        tree = ir.optimize_ir(ir.DefNode(
+                'f()',
+                ir.IfNode('1 + 1 == 3', ir.TextNode('a')),
+                ir.ElseNode(ir.ExprNode('"b" * 2')),
+                ir.ExprNode('[]'),
+                ir.ExprNode('1 / 0')))
+        assert [ type(x) for x in tree.body ] == [
+            ir.TextNode, ir.ExprNode, ir.ExprNode ], tree.body
+        assert tree.body[0].text == 'bb', tree.body[0].text
+
+    def test_rebound(self):
+        tree = ir.optimize_ir(ir.DefNode(
+                'f(DEBUG)',
+                ir.IfNode('DEBUG', ir.TextNode('a'))), dict(DEBUG=False))
+        assert type(tree.body[0]) == ir.IfNode, tree.body
+
+    def test_context(self):
+        # The constants override the context values of the same name,
+        # whether their uses are folded or not
+        tpl = kajiki.XMLTemplate(
+            '<a>${V} ${V+x} <b py:if="V == 3">three</b>'
+            '<b py:if="V + x == 9">nine</b></a>', constants=dict(V=3))
+        rsp = tpl(dict(V=9, x=0)).render()
+        assert rsp == '<a>3 3 <b>three</b></a>', rsp
+
+    def test_invalid(self):
+        for constants in (dict(DEBUG=object()), {'a b': 1}):
+            try:
+                ir.optimize_ir(self.tpl, constants)
+                assert False, 'Should have raised ValueError'
+            except ValueError:
+                pass
+
 class TestImport(TestCase):
     
     def setUp(self):
@@ -0,0 +1,316 @@
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import traceback
+from unittest import TestCase, main
+
+import kajiki
+import kajiki.compile
+from kajiki import FileLoader, PrecompiledLoader
+from kajiki.cache import CodeCache
+
+DATA = os.path.join(
+    os.path.dirname(__file__),
+    'data')
+
+class TestCodeCache(TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.base, 'cache')
+        self.tpl_dir = os.path.join(self.base, 'tpl')
+        os.mkdir(self.tpl_dir)
+        self.write('hello.html', '<div py:for="i in range(2)">Hello, $name</div>')
+        self.write('hello.txt', 'Hello, $name')
+        shutil.copy(os.path.join(DATA, 'debug.html'), self.tpl_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def write(self, name, text):
+        f = open(os.path.join(self.tpl_dir, name), 'w')
+        f.write(text)
+        f.close()
+
+    def entries(self):
+        return [ fn for fn in os.listdir(self.cache_dir)
+                 if fn.endswith(CodeCache.suffix) ]
+
+    def test_reuse(self):
+        loader = FileLoader(self.tpl_dir, cache_dir=self.cache_dir)
+        rsp = loader.import_('hello.html')(dict(name='Rick')).render()
+        assert rsp == '<div>Hello, Rick</div><div>Hello, Rick</div>', rsp
+        loader.import_('hello.txt')
+        assert len(self.entries()) == 2, self.entries()
+        # A fresh loader must not parse or compile anything
+        parse = kajiki.xml_template._Parser.parse
+        def fail(*args, **kwargs):
+            assert False, 'template was recompiled'
+        kajiki.xml_template._Parser.parse = fail
+        try:
+            loader = FileLoader(self.tpl_dir, cache_dir=self.cache_dir)
+            tpl = loader.import_('hello.html')
+        finally:
+            kajiki.xml_template._Parser.parse = parse
+        rsp = tpl(dict(name='Rick')).render()
+        assert rsp == '<div>Hello, Rick</div><div>Hello, Rick</div>', rsp
+        assert 'Hello' in tpl.py_text, tpl.py_text
+        assert len(self.entries()) == 2, self.entries()
+
+    def test_options(self):
+        FileLoader(self.tpl_dir, cache_dir=self.cache_dir).import_('hello.html')
+        FileLoader(self.tpl_dir, cache_dir=self.cache_dir,
+                   buffered=True).import_('hello.html')
+        FileLoader(self.tpl_dir, cache_dir=self.cache_dir,
+                   force_mode='text').import_('hello.html')
+        self.write('hello.html', '<div>Goodbye, $name</div>')
+        loader = FileLoader(self.tpl_dir, cache_dir=self.cache_dir)
+        rsp = loader.import_('hello.html')(dict(name='Rick')).render()
+        assert rsp == '<div>Goodbye, Rick</div>', rsp
+        assert len(self.entries()) == 4, self.entries()
+
+    def test_constants(self):
+        self.write('flag.xml', '<div><p py:if="DEBUG">debug</p>'
+                   '<p py:else="">$name</p></div>')
+        for debug in (False, True, False):
+            loader = FileLoader(self.tpl_dir, cache_dir=self.cache_dir,
+                                constants=dict(DEBUG=debug))
+            tpl = loader.import_('flag.xml')
+            assert 'if DEBUG' not in tpl.py_text, tpl.py_text
+            rsp = tpl(dict(name='Rick')).render()
+            assert rsp == (debug and '<div><p>debug</p></div>'
+                           or '<div><p>Rick</p></div>'), rsp
+        # Each set of constants has its own entry
+        assert len(self.entries()) == 2, self.entries()
+
+    def test_corrupt(self):
+        FileLoader(self.tpl_dir, cache_dir=self.cache_dir).import_('hello.txt')
+        for fn in self.entries():
+            f = open(os.path.join(self.cache_dir, fn), 'wb')
+            f.write('\xff\x00garbage')
+            f.close()
+        loader = FileLoader(self.tpl_dir, cache_dir=self.cache_dir)
+        rsp = loader.import_('hello.txt')(dict(name='Rick')).render()
+        assert rsp == 'Hello, Rick', rsp
+
+    def test_debug(self):
+        FileLoader(self.tpl_dir, cache_dir=self.cache_dir).import_('debug.html')
+        loader = FileLoader(self.tpl_dir, cache_dir=self.cache_dir)
+        tpl = loader.import_('debug.html')
+        try:
+            tpl().render()
+            assert False, 'Should have raised ValueError'
+        except ValueError:
+            stack = traceback.extract_tb(sys.exc_info()[2])
+        for fn, lno, func, line in stack:
+            if fn.endswith('debug.html'): break
+        else:
+            assert False, 'Stacktrace is all python'
+
+class TestResolveExtends(TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.write('layout.html', '<div><h1>${title()}</h1>'
+                   '<py:block name="body">Empty</py:block></div>')
+        self.write('page.html',
+                   '<py:extends href="site.html"><py:block name="body"'
+                   '>Hello, $name</py:block></py:extends>')
+        self.write('site.html',
+                   '<py:extends href="layout.html"><py:def function="title()"'
+                   '>Site</py:def></py:extends>')
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def write(self, name, text, mtime=None):
+        path = os.path.join(self.base, name)
+        f = open(path, 'w')
+        f.write(text)
+        f.close()
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def test_reload(self):
+        loader = FileLoader(self.base, resolve_extends=True)
+        page = loader.import_('page.html')
+        rsp = page(dict(name='Rick')).render()
+        assert rsp == '<div><h1>Site</h1>Hello, Rick</div>', rsp
+        assert loader.import_('page.html') is page
+        # Changing an ancestor rebuilds the merged template
+        mtime = os.stat(os.path.join(self.base, 'layout.html')).st_mtime
+        self.write('layout.html', '<span><b>${title()}</b>'
+                   '<py:block name="body">Empty</py:block></span>', mtime + 10)
+        page = loader.import_('page.html')
+        rsp = page(dict(name='Rick')).render()
+        assert rsp == '<span><b>Site</b>Hello, Rick</span>', rsp
+
+class TestInlineIncludes(TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.base, 'cache')
+        self.tpl_dir = os.path.join(self.base, 'tpl')
+        os.mkdir(self.tpl_dir)
+        self.write('header.html', '<h1>Hello, ${"world"}</h1>')
+        self.write('nav.html', '<ul><li py:for="i in range(2)">$i</li></ul>')
+        self.write('page.html',
+                   '<div><py:include href="header.html"/>'
+                   '<py:include href="nav.html"/><p>Body</p></div>')
+        self.write('a.html', '<div><py:include href="b.html"/></div>')
+        self.write('b.html', '<span py:if="\'\'.strip()">'
+                   '<py:include href="a.html"/></span>')
+        self.write('scope.html', '<span><b py:if="local.defined(\'name\')">'
+                   'Hello, $name</b><b py:else="">Anonymous</b></span>')
+        self.write('user.html', '<div><py:include href="scope.html"/></div>')
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def write(self, name, text, mtime=None):
+        path = os.path.join(self.tpl_dir, name)
+        f = open(path, 'w')
+        f.write(text)
+        f.close()
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def render(self, loader, name):
+        return loader.import_(name)().render()
+
+    def test_inline(self):
+        loader = FileLoader(self.tpl_dir, inline_includes=True)
+        page = loader.import_('page.html')
+        assert 'header.html' not in page.py_text, page.py_text
+        # The nav partial binds a name, so it is still included at runtime
+        assert 'nav.html' in page.py_text, page.py_text
+        rsp = page().render()
+        expected = self.render(FileLoader(self.tpl_dir), 'page.html')
+        assert rsp == expected, rsp
+        assert rsp == ('<div><h1>Hello, world</h1><ul><li>0<li>1'
+                       '</ul><p>Body</div>'), rsp
+
+    def test_recursive(self):
+        loader = FileLoader(self.tpl_dir, inline_includes=True)
+        a = loader.import_('a.html')
+        assert 'b.html' not in a.py_text, a.py_text
+        assert 'a.html' in a.py_text, a.py_text
+        rsp = a().render()
+        assert rsp == '<div></div>', rsp
+
+    def test_scope(self):
+        # A template reading names is included at runtime, with an empty
+        # context, whether inlining is enabled or not
+        loader = FileLoader(self.tpl_dir, inline_includes=True)
+        user = loader.import_('user.html')
+        assert 'scope.html' in user.py_text, user.py_text
+        rsp = user(dict(name='Rick')).render()
+        expected = FileLoader(self.tpl_dir).import_('user.html')(
+            dict(name='Rick')).render()
+        assert rsp == expected, rsp
+        assert rsp == '<div><span><b>Anonymous</b></span></div>', rsp
+
+    def test_reload(self):
+        loader = FileLoader(self.tpl_dir, inline_includes=True)
+        page = loader.import_('page.html')
+        assert loader.import_('page.html') is page
+        mtime = os.stat(os.path.join(self.tpl_dir, 'header.html')).st_mtime
+        self.write('header.html', '<h2>Bye</h2>', mtime + 10)
+        rsp = self.render(loader, 'page.html')
+        assert rsp.startswith('<div><h2>Bye</h2>'), rsp
+
+    def test_cache(self):
+        def loader():
+            return FileLoader(self.tpl_dir, cache_dir=self.cache_dir,
+                              inline_includes=True)
+        rsp = self.render(loader(), 'page.html')
+        assert rsp.startswith('<div><h1>Hello, world</h1>'), rsp
+        self.write('header.html', '<h2>Bye</h2>')
+        rsp = self.render(loader(), 'page.html')
+        assert rsp.startswith('<div><h2>Bye</h2>'), rsp
+
+class TestPrecompiled(TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.tpl_dir = os.path.join(self.base, 'tpl')
+        self.out_dir = os.path.join(self.base, 'out')
+        os.makedirs(os.path.join(self.tpl_dir, 'lib'))
+        self.write('lib/parent.html',
+                   '<div><py:block name="body">Parent</py:block></div>')
+        self.write('child.html',
+                   '<py:extends href="lib/parent.html"><py:block name="body"'
+                   '>Hello, $name</py:block></py:extends>')
+        self.write('hello.txt', 'Hello, $name')
+        shutil.copy(os.path.join(DATA, 'debug.html'), self.tpl_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def write(self, name, text):
+        f = open(os.path.join(self.tpl_dir, name), 'w')
+        f.write(text)
+        f.close()
+
+    def test_compile(self):
+        paths = kajiki.compile.compile_tree(self.tpl_dir, self.out_dir, jobs=2)
+        assert len(paths) == 4, paths
+        # Loading the compiled modules must not parse or compile anything
+        parse = kajiki.xml_template._Parser.parse
+        def fail(*args, **kwargs):
+            assert False, 'template was recompiled'
+        kajiki.xml_template._Parser.parse = fail
+        try:
+            loader = PrecompiledLoader(self.out_dir)
+            child = loader.import_('child.html')
+            hello = loader.import_('hello.txt')
+            rsp = child(dict(name='Rick')).render()
+        finally:
+            kajiki.xml_template._Parser.parse = parse
+        assert rsp == '<div>Hello, Rick</div>', rsp
+        rsp = hello(dict(name='Rick')).render()
+        assert rsp == 'Hello, Rick', rsp
+
+    def test_bytecode_only(self):
+        kajiki.compile.compile_tree(self.tpl_dir, self.out_dir, jobs=1,
+                                    buffered=True)
+        os.unlink(os.path.join(self.out_dir, 'hello.txt.py'))
+        loader = PrecompiledLoader(self.out_dir)
+        rsp = loader.import_('hello.txt')(dict(name='Rick')).render()
+        assert rsp == 'Hello, Rick', rsp
+
+    def test_runtime_only(self):
+        kajiki.compile.compile_tree(self.tpl_dir, self.out_dir, jobs=1)
+        script = '\n'.join([
+            'import sys',
+            'from kajiki.runtime import PrecompiledLoader',
+            'loader = PrecompiledLoader(%r)' % self.out_dir,
+            'sys.stdout.write(loader.import_("child.html")(',
+            '    dict(name="Rick")).render())',
+            'for name in ("ir", "xml_template", "text", "cache"):',
+            '    assert "kajiki." + name not in sys.modules, name' ])
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        proc = subprocess.Popen([sys.executable, '-c', script], env=env,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        assert proc.returncode == 0, err
+        assert out == '<div>Hello, Rick</div>', out
+
+    def test_debug(self):
+        kajiki.compile.main(['-q', self.tpl_dir, self.out_dir])
+        tpl = PrecompiledLoader(self.out_dir).import_('debug.html')
+        try:
+            tpl().render()
+            assert False, 'Should have raised ValueError'
+        except ValueError:
+            stack = traceback.extract_tb(sys.exc_info()[2])
+        for fn, lno, func, line in stack:
+            if fn.endswith('debug.html'): break
+        else:
+            assert False, 'Stacktrace is all python'
+
+if __name__ == '__main__':
+    main()
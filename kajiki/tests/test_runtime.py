@@ -1,6 +1,7 @@
 from unittest import TestCase, main
 
 import kajiki
+import kajiki.cache
 
 class TestBasic(TestCase):
 
@@ -58,6 +59,14 @@ class TestFunction(TestCase):
         rsp = self.tpl(dict(name='Rick')).render()
         assert rsp == '0 is even\n1 is odd\n', rsp
 
+    def test_bound(self):
+        a, b = self.tpl(), self.tpl()
+        assert a.evenness is not b.evenness
+        assert a.__globals__['evenness'] is a.evenness
+        assert isinstance(a.evenness(2), kajiki.flattener)
+        rsp = list(a.evenness(3))
+        assert rsp == ['odd'], rsp
+
 class TestCall(TestCase):
     
     def setUp(self):
@@ -234,5 +243,94 @@ class TestDynamicExtends(TestCase):
         rsp = self.child_tpl(dict(p=1)).render()
         assert rsp == 'Parent 1', rsp
 
+class TestInstantiate(TestCase):
+
+    def setUp(self):
+        class tpl:
+            @kajiki.expose
+            def greet():
+                yield greeting
+            @kajiki.expose
+            def __main__():
+                local.__kj__.push_switch(name)
+                if local.__kj__.case('Rick'):
+                    yield greet()
+                yield ', '
+                yield name
+                local.__kj__.pop_switch()
+        self.tpl = kajiki.Template(tpl)
+        self.tpl.base_globals = dict(greeting='Hello')
+
+    def test_instances(self):
+        a = self.tpl(dict(name='Rick'))
+        b = self.tpl(dict(name='Mark'))
+        assert a.greet is not b.greet
+        rsp = b.render()
+        assert rsp == ', Mark', rsp
+        rsp = a.render()
+        assert rsp == 'Hello, Rick', rsp
+
+    def test_base_globals(self):
+        self.tpl(dict(name='Rick')).render()
+        self.tpl.base_globals = dict(greeting='Howdy')
+        rsp = self.tpl(dict(name='Rick')).render()
+        assert rsp == 'Howdy, Rick', rsp
+
+class TestMemoryStore(TestCase):
+
+    def test_lru(self):
+        store = kajiki.cache.MemoryStore(max_entries=2)
+        store.set(u'a', u'A')
+        store.set(u'b', u'B')
+        assert store.get(u'a') == u'A'
+        store.set(u'c', u'C')
+        # b was the least recently used entry
+        assert store.get(u'b') is None
+        assert store.get(u'a') == u'A'
+        assert store.get(u'c') == u'C'
+        assert len(store) == 2
+
+    def test_ttl(self):
+        store = kajiki.cache.MemoryStore(default_ttl=-1)
+        store.set(u'a', u'A')
+        store.set(u'b', u'B', ttl=60)
+        assert store.get(u'a') is None
+        assert store.get(u'b') == u'B'
+        assert len(store) == 1
+
+class TestEscape(TestCase):
+
+    def test_escape(self):
+        from kajiki.template import escape, escape_attr
+        for value, text in [ (5, u'5'), (2.5, u'2.5'), (True, u'True'),
+                             ('a<b', u'a&lt;b'), (u'&"', u'&amp;"') ]:
+            rsp = escape(value)
+            assert rsp == text and type(rsp) == unicode, rsp
+        rsp = escape(kajiki.rendered(u'<b>'))
+        assert rsp == u'<b>', rsp
+        assert escape(None) is None
+        rsp = escape_attr(u'<a href="x">')
+        assert rsp == u'&lt;a href=&#34;x&#34;&gt;', rsp
+
+class TestFlattener(TestCase):
+
+    def test_nested(self):
+        def nest(depth):
+            yield 'a%d' % depth
+            if depth:
+                yield kajiki.flattener(nest(depth-1))
+            yield None
+            yield 'b%d' % depth
+        rsp = list(kajiki.flattener(nest(200)))
+        expected = ([ 'a%d' % d for d in reversed(range(201)) ]
+                    + [ 'b%d' % d for d in range(201) ])
+        assert rsp == expected, rsp
+
+    def test_list(self):
+        f = kajiki.flattener([ 'a', kajiki.flattener(iter([])),
+                               kajiki.flattener(['b', None]), 'c' ])
+        rsp = list(f)
+        assert rsp == ['a', 'b', 'c'], rsp
+
 if __name__ == '__main__':
     main()
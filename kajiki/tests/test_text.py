@@ -3,6 +3,7 @@ import sys
 import traceback
 from unittest import TestCase, main
 
+import kajiki
 from kajiki import MockLoader, FileLoader, TextTemplate
 
 class TestBasic(TestCase):
@@ -35,6 +36,18 @@ class TestBasic(TestCase):
         rsp = tpl(dict(name='Rick')).render() 
         assert rsp == 'Hello, Rick\n', rsp
 
+    def test_expr_brace_string(self):
+        tpl = TextTemplate(source="""${"$x}" + '{'} ${ (name,
+  "}")[0] } ${'''}}''' # }
+}""")
+        rsp = tpl(dict(name='Rick')).render()
+        assert rsp == '$x}{ Rick }}', rsp
+        try:
+            TextTemplate(source='Hello, ${name(}\n')
+            assert False, 'Should have raised SyntaxError'
+        except SyntaxError:
+            pass
+
     def test_expr_name(self):
         tpl = TextTemplate(source='Hello, $name\n')
         rsp = tpl(dict(name='Rick')).render() 
@@ -102,6 +115,38 @@ Nevermore $n\\
             rsp == 'Quoth the raven, "Nevermore 0."\n'
             'Quoth the raven, "Nevermore 1."\n'), rsp
 
+class TestCache(TestCase):
+
+    def test_cache(self):
+        tpl = TextTemplate(source='''%for i in items
+{%cache i%}${calls.append(i) or i}{%end%}
+%end
+''')
+        tpl.fragment_cache = kajiki.cache.MemoryStore()
+        calls = []
+        rsp = tpl(dict(items=[1, 2], calls=calls)).render()
+        assert rsp == '1\n2\n', rsp
+        rsp = tpl(dict(items=[2, 1], calls=calls)).render()
+        assert rsp == '2\n1\n', rsp
+        assert calls == [1, 2], calls
+
+class TestConstants(TestCase):
+
+    def test_if(self):
+        source = """%if DEBUG
+debug $name
+%else
+${MODE.upper()}
+%end
+"""
+        tpl = TextTemplate(source, constants=dict(DEBUG=True, MODE='prod'))
+        rsp = tpl(dict(name='Rick')).render()
+        assert rsp == 'debug Rick\n', rsp
+        assert 'if DEBUG' not in tpl.py_text, tpl.py_text
+        tpl = TextTemplate(source, constants=dict(DEBUG=False, MODE='prod'))
+        rsp = tpl(dict(name='Rick')).render()
+        assert rsp == 'PROD\n', rsp
+
 class TestImport(TestCase):
 
     def test_import(self):
@@ -166,6 +211,10 @@ b
         assert rsp == 'a\n# header\nb\n', rsp
 
 class TestExtends(TestCase):
+    resolve_extends = False
+
+    def loader(self, modules):
+        return MockLoader(modules, resolve_extends=self.resolve_extends)
 
     def test_basic(self):
         parent = TextTemplate('''
@@ -200,7 +249,7 @@ child\\
 ${parent.body()}\\
 %end
 ''')
-        loader = MockLoader({
+        loader = self.loader({
             'parent.txt':parent,
             'mid.txt':mid,
             'child.txt':child})
@@ -216,7 +265,7 @@ ${parent.body()}\\
                 '# Footer\n'), rsp
 
     def test_dynamic(self):
-        loader = MockLoader({
+        loader = self.loader({
                 'parent0.txt':TextTemplate('Parent 0'),
                 'parent1.txt':TextTemplate('Parent 1'),
                 'child.txt':TextTemplate('''%if p == 0
@@ -233,7 +282,7 @@ ${parent.body()}\\
         assert rsp == 'Parent 1', rsp
 
     def test_block(self):
-        loader = MockLoader({
+        loader = self.loader({
                 'parent.txt':TextTemplate('''%def greet(name)
 Hello, $name!\\
 %end
@@ -271,6 +320,20 @@ Rick
 '''), rsp
         
 
+class TestResolvedExtends(TestExtends):
+    resolve_extends = True
+
+    def test_merged(self):
+        loader = self.loader({
+                'parent.txt':TextTemplate('Parent'),
+                'child.txt':TextTemplate('%extends "parent.txt"\n')})
+        tpl = loader.import_('child.txt')
+        assert tpl._chain[1] is loader.import_('parent.txt')
+        inst = tpl()
+        assert inst.__globals__['parent'] is inst._extended
+        rsp = inst.render()
+        assert rsp == 'Parent', rsp
+
 class TestClosure(TestCase):
     
     def test(self):
@@ -319,6 +382,19 @@ ${test()}''')
         rsp = tpl(dict(name='Rick')).render()
         assert rsp == 'a/b/c'
 
+class TestBuffered(TestCase):
+
+    def test_buffered(self):
+        tpl = TextTemplate('''%def evenness(n)
+{%if n % 2 == 0 %}even{%else%}odd{%end%}\\
+%end
+%for i in range(3)
+$i is ${evenness(i)}${none}
+%end
+''', buffered=True)
+        rsp = tpl(dict(none=None)).render()
+        assert rsp == '0 is even\n1 is odd\n2 is even\n', rsp
+
 class TestDebug(TestCase):
     
     def test_debug(self):
@@ -29,6 +29,20 @@ class TestParser(TestCase):
 </div>''').parse()
         xml.dom.minidom.parseString(doc.toxml().encode('utf-8'))
 
+    def test_text(self):
+        doc = kajiki.xml_template._Parser('<string>', '''<div
+>a &amp; ${"b"} &lt;
+c<br py:if="x"/></div>''').parse()
+        # Expanding a parsed document again does not change it
+        kajiki.xml_template.expand(doc)
+        div = doc.childNodes[0]
+        assert len(div.childNodes) == 2, div.childNodes
+        text, br = div.childNodes
+        assert text.data == u'a &amp; ${"b"} &lt;\nc', text.data
+        assert text.lineno == 2, text.lineno
+        assert br.tagName == 'py:if', br.tagName
+        assert br.childNodes[0].tagName == 'br', br.childNodes
+
 class TestExpand(TestCase):
 
     def test_expand(self):
@@ -41,6 +55,7 @@ class TestExpand(TestCase):
         py:if="if"
         py:switch="switch"
         py:with="with"
+        py:cache="cache"
         py:replace="replace"
         py:block="block"
         py:extends="extends">Foo</div>''').parse()
@@ -88,6 +103,13 @@ class TestSimple(TestCase):
         rsp = tpl(dict(name='Rick')).render() 
         assert rsp == '<div>Hello, Rick</div>', rsp
 
+    def test_expr_brace_string(self):
+        tpl = XMLTemplate(source='''<div>${"$x}" + '{'} ${1 &lt; 2}
+${ "a&amp;b" +
+  name }</div>''')
+        rsp = tpl(dict(name='Rick')).render()
+        assert rsp == '<div>$x}{ True\na&amp;bRick</div>', rsp
+
     def test_entity(self):
         x = "<div>Cookies &amp; Cream</div>"
         tpl = XMLTemplate(source=x)
@@ -107,6 +129,31 @@ $i is <py:switch test="i % 2">
 0 is even</div><div>
 1 is odd</div>''', rsp
 
+    def test_else(self):
+        tpl = XMLTemplate(source='''<div py:for="i in range(3)"
+><py:switch test="i"><py:case value="0">zero</py:case
+><py:case value="1">one</py:case><py:else>many</py:else
+></py:switch></div>''')
+        rsp = tpl().render()
+        assert rsp == '<div>zero</div><div>one</div><div>many</div>', rsp
+
+    def test_dispatch(self):
+        cases = ''.join('<py:case value="%d">%d</py:case>' % (i, i)
+                        for i in range(kajiki.ir.DISPATCH_CASES))
+        tpl = XMLTemplate(source='''<div py:for="i in values"
+><py:switch test="i">%s<py:case value="True">true</py:case
+><py:else>none</py:else></py:switch></div>''' % cases)
+        assert 'try:' in tpl.py_text, tpl.py_text
+        # True == 1, so the first of these cases wins, and unhashable
+        # values match no case
+        rsp = tpl(dict(values=[0, 5, True, 99, [], 11])).render()
+        assert rsp == ('<div>0</div><div>5</div><div>1</div>'
+                       '<div>none</div><div>none</div><div>11</div>'), rsp
+        tpl = XMLTemplate(source='''<div py:for="i in values"
+><py:switch test="i">%s</py:switch></div>''' % cases)
+        rsp = tpl(dict(values=[2, 99])).render()
+        assert rsp == '<div>2</div><div></div>', rsp
+
 class TestWith(TestCase):
 
     def test_with(self):
@@ -122,6 +169,69 @@ class TestWith(TestCase):
 <div>foo</div>
 </div>''', rsp
 
+    def test_multiple(self):
+        tpl = XMLTemplate(source='''<div py:with="a=1; b = a + 1"
+><span py:for="i in range(2)" py:with="a=a+i; c=a*b">$a $c,</span
+>$a $b</div>''')
+        assert 'locals()' not in tpl.py_text, tpl.py_text
+        rsp = tpl().render()
+        assert rsp == '<div><span>1 2,</span><span>2 4,</span>1 2</div>', rsp
+
+class TestCache(TestCase):
+
+    def setUp(self):
+        self.store = kajiki.cache.MemoryStore()
+        self.calls = []
+
+    def render(self, tpl, **context):
+        tpl.fragment_cache = self.store
+        context.update(calls=self.calls)
+        return tpl(context).render()
+
+    def test_cache(self):
+        tpl = XMLTemplate(source='''<div><p py:for="i in items" py:cache="i"
+>${calls.append(i) or i}</p></div>''')
+        rsp = self.render(tpl, items=[1, 2])
+        assert rsp == '<div><p>1</p><p>2</p></div>', rsp
+        rsp = self.render(tpl, items=[2, 3, 1])
+        assert rsp == '<div><p>2</p><p>3</p><p>1</p></div>', rsp
+        assert self.calls == [1, 2, 3], self.calls
+
+    def test_fragments(self):
+        # Different fragments (and templates) never share their text
+        tpl = XMLTemplate(source='''<div><py:cache key="0">a$x</py:cache
+><py:cache key="0">b$x</py:cache></div>''')
+        other = XMLTemplate(source='''<div><py:cache key="0">a$x</py:cache
+><py:cache key="0">c$x</py:cache></div>''')
+        rsp = self.render(tpl, x=1)
+        assert rsp == '<div>a1b1</div>', rsp
+        rsp = self.render(other, x=2)
+        assert rsp == '<div>a1c2</div>', rsp
+
+    def test_ttl(self):
+        tpl = XMLTemplate(source='''<div py:cache="0, ttl=-1">$x</div>''')
+        rsp = self.render(tpl, x=1)
+        assert rsp == '<div>1</div>', rsp
+        rsp = self.render(tpl, x=2)
+        assert rsp == '<div>2</div>', rsp
+
+    def test_buffered(self):
+        tpl = XMLTemplate(source='''<div py:cache="0">${x}</div>''',
+                          buffered=True)
+        rsp = self.render(tpl, x='<b>')
+        assert rsp == '<div>&lt;b&gt;</div>', rsp
+        rsp = self.render(tpl, x='<i>')
+        assert rsp == '<div>&lt;b&gt;</div>', rsp
+
+    def test_loader(self):
+        loader = MockLoader({
+                'tpl.html': XMLTemplate('<div py:cache="0">$x</div>')})
+        loader.fragment_cache = self.store
+        tpl = loader.import_('tpl.html')
+        rsp = tpl(dict(x=1)).render()
+        assert rsp == '<div>1</div>', rsp
+        assert len(self.store) == 1
+
 class TestFunction(TestCase):
 
     def test_function(self):
@@ -151,6 +261,25 @@ class TestCall(TestCase):
     <li>Quoth the raven, Nevermore 0</li><li>Quoth the raven, Nevermore 1</li>
 </ul></div>''', rsp
 
+    def test_loop(self):
+        tpl = XMLTemplate(source='''<div
+><py:def function="field(caller, name)">$name=${caller()};</py:def
+><py:def function="form(fields)"><p py:for="i, f in enumerate(fields)"
+><py:call function="field(%caller, f)">$i</py:call
+><py:def function="twice(x)">$x$x</py:def>${twice(f)}<py:def
+function="label(x=f.upper())">$x</py:def>${label()}</p></py:def
+>${form(['a', 'b'])}</div>''')
+        # The caller and twice() are only defined once, label() has a
+        # default value which must be evaluated on each iteration
+        lines = [ l.strip() for l in tpl.py_text.splitlines() ]
+        loop = lines.index('for i, f in enumerate(fields):')
+        assert lines.index('def twice(x):') < loop, lines
+        assert lines.index('def label(x=f.upper()):') > loop, lines
+        assert len([ l for l in lines[:loop]
+                     if l.startswith('def _kj_') ]) == 1, lines
+        rsp = tpl().render()
+        assert rsp == '<div><p>a=0;aaA</p><p>b=1;bbB</p></div>', rsp
+
 class TestImport(TestCase):
     
     def test_import(self):
@@ -243,9 +372,13 @@ class TestImport(TestCase):
 </body></html>''', rsp
 
 class TestExtends(TestCase):
+    resolve_extends = False
+
+    def loader(self, modules):
+        return MockLoader(modules, resolve_extends=self.resolve_extends)
 
     def test_basic(self):
-        loader = MockLoader({
+        loader = self.loader({
                 'parent.html':XMLTemplate('''<div
 ><h1 py:def="header()">Header name=$name</h1
 ><h6 py:def="footer()">Footer</h6
@@ -285,7 +418,7 @@ child.id() = <span>mid</span>
 </div>''', rsp
 
     def test_dynamic(self):
-        loader = MockLoader({
+        loader = self.loader({
                 'parent0.html':XMLTemplate('<span>Parent 0</span>'),
                 'parent1.html':XMLTemplate('<span>Parent 1</span>'),
                 'child.html':XMLTemplate('''<div
@@ -301,7 +434,7 @@ child.id() = <span>mid</span>
         assert rsp == '<div><span>Parent 1</span></div>', rsp
 
     def test_block(self):
-        loader = MockLoader({
+        loader = self.loader({
                 'parent.html':XMLTemplate('''<div
 ><py:def function="greet(name)"
 >Hello, $name!</py:def
@@ -343,6 +476,38 @@ Thanks for the gift!</p>
 Sincerely,<br/><em>Rick</em>
 </div>''', rsp
 
+class TestResolvedExtends(TestExtends):
+    resolve_extends = True
+
+    def test_merged(self):
+        loader = self.loader({
+                'parent.html':XMLTemplate('<p>Parent</p>'),
+                'child.html':XMLTemplate('<py:extends href="parent.html"/>')})
+        tpl = loader.import_('child.html')
+        assert tpl._chain[1] is loader.import_('parent.html')
+        inst = tpl()
+        assert inst.__globals__['parent'] is inst._extended
+        rsp = inst.render()
+        assert rsp == '<p>Parent</p>', rsp
+
+    def test_overridden(self):
+        loader = self.loader({
+                'parent.html':XMLTemplate('''<p><py:def function="id()"
+>parent</py:def>${id()}</p>'''),
+                'mid.html':XMLTemplate('''<py:extends href="parent.html"
+><py:def function="id()">mid ${parent.id()}</py:def></py:extends>'''),
+                'child.html':XMLTemplate('''<py:extends href="mid.html"
+><py:def function="id()">child ${parent.id()}</py:def></py:extends>''')})
+        tpl = loader.import_('child.html')
+        inst = tpl()
+        # Only the child is constructed
+        mid = inst._extended
+        assert 'id' not in mid.__dict__
+        assert isinstance(mid, tpl._chain[1])
+        rsp = inst.render()
+        assert rsp == '<p>child mid parent</p>', rsp
+        assert inst.render() == rsp
+
 class TestClosure(TestCase):
     
     def test(self):
@@ -431,12 +596,66 @@ class TestAttributes(TestCase):
         rsp = tpl(dict(name='Rick')).render()
         assert rsp == '<div/>'
 
+    def test_static(self):
+        tpl = XMLTemplate('''<div><input type="checkbox" class="a&amp;b&lt;"
+ checked="" id="$id"/></div>''', mode='html')
+        rsp = tpl(dict(id='x')).render()
+        assert rsp == (
+            '<div><input checked class="a&amp;b&lt;" id="x" type="checkbox">'
+            '</div>'), rsp
+        # The static attributes are merged with the surrounding text
+        assert "u'<div><input checked class=" in tpl.py_text, tpl.py_text
+        assert "u' type=\"checkbox\"></div>'" in tpl.py_text, tpl.py_text
+
+    def test_dynamic(self):
+        tpl = XMLTemplate('''<a href="?q=$q&amp;p=1" class="$a$b"
+title="$a" id="x${a}y"/>''')
+        rsp = tpl(dict(q='<&>', a=None, b=None)).render()
+        assert rsp == '<a href="?q=&lt;&amp;&gt;&amp;p=1" id="xy"/>', rsp
+        rsp = tpl(dict(q=1, a=2, b=None)).render()
+        assert rsp == '<a class="2" href="?q=1&amp;p=1" id="x2y" title="2"/>', rsp
+        tpl = XMLTemplate('''<div py:for="i in range(2)" class="${i}"
+ py:strip="i"/>''', buffered=True)
+        rsp = tpl().render()
+        assert rsp == '<div class="0"/>', rsp
+
+    def test_quotes(self):
+        tpl = XMLTemplate('''<div title="&quot;$a&quot;" class="$a"
+ py:attrs="dict(id=a)">$a</div>''')
+        rsp = tpl(dict(a='"<b>"')).render()
+        assert rsp == ('<div class="&#34;&lt;b&gt;&#34;"'
+                       ' title="&#34;&#34;&lt;b&gt;&#34;&#34;"'
+                       ' id="&#34;&lt;b&gt;&#34;">"&lt;b&gt;"</div>'), rsp
+
+    def test_escaper(self):
+        class Upper(kajiki.template.Escaper):
+            escape = staticmethod(lambda v: unicode(v).upper())
+        tpl = XMLTemplate('''<div class="$a">$a</div>''')
+        rsp = tpl(dict(a='<b>')).render()
+        assert rsp == '<div class="&lt;b&gt;">&lt;b&gt;</div>', rsp
+        tpl.escaper = Upper()
+        rsp = tpl(dict(a='<b>')).render()
+        assert rsp == '<div class="&lt;b&gt;"><B></div>', rsp
+
     def test_strip(self):
         tpl = XMLTemplate('''<div><h1 py:strip="header">Header</h1></div>''')
         rsp = tpl(dict(header=True)).render()
         assert rsp == '<div>Header</div>', rsp
         rsp = tpl(dict(header=False)).render()
         assert rsp == '<div><h1>Header</h1></div>', rsp
+        # The expression is evaluated once per element
+        calls = []
+        tpl = XMLTemplate('''<div><h1 py:strip="strip(i)" py:for="i in range(2)"
+ class="$i">$i</h1></div>''')
+        rsp = tpl(dict(strip=lambda i: calls.append(i) or i)).render()
+        assert rsp == '<div><h1 class="0">0</h1>1</div>', rsp
+        assert calls == [0, 1], calls
+        # Constant values are applied at compile time
+        tpl = XMLTemplate('''<div><h1 py:strip="">a</h1><h2 py:strip="1"
+>b</h2><h3 py:strip="False">c</h3></div>''')
+        assert 'not' not in tpl.py_text, tpl.py_text
+        rsp = tpl().render()
+        assert rsp == '<div>ab<h3>c</h3></div>', rsp
 
     def test_html_attrs(self):
         tpl = XMLTemplate('''<input type="checkbox" checked="$checked"/>''', mode='xml')
@@ -461,6 +680,87 @@ class TestAttributes(TestCase):
         rsp = tpl(dict(checked=None)).render()
         assert rsp == '<input type="checkbox">', rsp
 
+class TestBuffered(TestCase):
+
+    def test_basic(self):
+        tpl = XMLTemplate('''<div py:for="i in range(2)" class="$cls"
+><span py:if="i">$i</span><py:else>${None}none</py:else></div>''',
+                          buffered=True)
+        rsp = tpl(dict(cls=None)).render()
+        assert rsp == '<div>none</div><div><span>1</span></div>', rsp
+        rsp = list(tpl(dict(cls='x')))
+        assert rsp == [
+            '<div class="x">none</div><div class="x"><span>1</span></div>'], rsp
+
+    def test_call(self):
+        tpl = XMLTemplate(source='''<div
+><py:def function="quote(caller, speaker)"
+><ul>
+    <li py:for="i in range(2)">Quoth $speaker, ${caller(i)}</li>
+</ul></py:def
+><py:call args="n" function="quote(%caller, 'the raven')"
+>Nevermore $n</py:call></div>''', buffered=True)
+        rsp = tpl(dict(name='Rick')).render()
+        assert rsp == '''<div><ul>
+    <li>Quoth the raven, Nevermore 0</li><li>Quoth the raven, Nevermore 1</li>
+</ul></div>''', rsp
+
+    def test_loop(self):
+        tpl = XMLTemplate(source='''<div
+><py:def function="field(caller, name)">$name=${caller()};</py:def
+><py:def function="form(fields)"><p py:for="i, f in enumerate(fields)"
+><py:call function="field(%caller, f)">$i</py:call
+><py:def function="twice(x)">$x$x</py:def>${twice(f)}<py:def
+function="label(x=f.upper())">$x</py:def>${label()}</p></py:def
+>${form(['a', 'b'])}</div>''', buffered=True)
+        # The caller and twice() are only defined once, label() has a
+        # default value which must be evaluated on each iteration
+        lines = [ l.strip() for l in tpl.py_text.splitlines() ]
+        loop = lines.index('for i, f in enumerate(fields):')
+        assert lines.index('def twice(x):') < loop, lines
+        assert lines.index('def label(x=f.upper()):') > loop, lines
+        assert len([ l for l in lines[:loop]
+                     if l.startswith('def _kj_') ]) == 1, lines
+        rsp = tpl().render()
+        assert rsp == '<div><p>a=0;aaA</p><p>b=1;bbB</p></div>', rsp
+
+    def test_mixed_import(self):
+        loader = MockLoader({
+            'lib.html':XMLTemplate(source='''<div
+><span py:def="evenness(n)">${'even' if n % 2 == 0 else 'odd'}</span
+></div>'''),
+            'tpl.html':XMLTemplate(source='''<div
+><py:import href="lib.html"
+/><p py:for="i in range(2)">${lib.evenness(i)} ${literal(br)}</p
+></div>''', buffered=True)})
+        tpl = loader.import_('tpl.html')
+        rsp = tpl(dict(br='<br/>')).render()
+        assert rsp == ('<div><p><span>even</span> <br/></p>'
+                       '<p><span>odd</span> <br/></p></div>'), rsp
+
+    def test_mixed_extends(self):
+        loader = MockLoader({
+            'parent.html':XMLTemplate('''<div
+><h1 py:def="header()">Header</h1
+>${header()}${body()}</div>''', buffered=True),
+            'child.html':XMLTemplate('''<py:extends href="parent.html"
+><p py:def="body()">Child ${parent.header()}</p
+></py:extends>''')})
+        rsp = loader.import_('child.html')().render()
+        assert rsp == '<div><h1>Header</h1><p>Child <h1>Header</h1></p></div>', rsp
+
+    def test_loader(self):
+        loader = FileLoader(base=DATA, buffered=True)
+        tpl = loader.import_('debug.html')
+        assert '_kj_append' in tpl.py_text, tpl.py_text
+        try:
+            tpl().render()
+            assert False, 'Should have raised ValueError'
+        except ValueError:
+            stack = traceback.extract_tb(sys.exc_info()[2])
+        assert [ fn for fn, lno, func, line in stack
+                 if fn.endswith('debug.html') ], stack
+
 class TestDebug(TestCase):
     
     def test_debug(self):
@@ -478,6 +778,26 @@ class TestDebug(TestCase):
         else:
             assert False, 'Stacktrace is all python'
 
+    def test_lineno(self):
+        tpl = XMLTemplate('''<div>
+<py:call args="n" function="quote(%caller)">
+    ${n / 0}
+</py:call>
+<py:def function="quote(caller)">
+    ${u''.join(caller(1))}
+</py:def>
+</div>''', filename='quote.html')
+        try:
+            tpl().render()
+            assert False, 'Should have raised ZeroDivisionError'
+        except ZeroDivisionError:
+            stack = traceback.extract_tb(sys.exc_info()[2])
+        # The functions defined later in the code, and those nested in
+        # others, also report their template lines
+        linenos = [ lno for fn, lno, func, line in stack
+                    if fn == 'quote.html' ]
+        assert linenos == [6, 3], stack
+
 class TestPackageLoader(TestCase):
 
     def test_pkg_loader(self):
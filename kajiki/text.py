@@ -15,6 +15,7 @@ from itertools import chain
 
 import kajiki
 from kajiki import ir
+from kajiki.util import braced_expr_end
 
 _pattern = r'''
 \$(?:
@@ -38,15 +39,31 @@ _re_pattern = re.compile(_pattern, re.VERBOSE | re.IGNORECASE|re.MULTILINE)
 def TextTemplate(
     source=None,
     filename=None,
-    autoescape=False):
+    autoescape=False,
+    buffered=False,
+    cache=None,
+    include=None,
+    ir_only=False,
+    constants=None):
     if source is None:
         source = open(filename).read()
     if filename is None:
         filename = '<string>'
-    scanner = _Scanner(filename, source)
-    tree = _Parser(scanner, autoescape).parse()
-    tree.filename = filename
-    return kajiki.template.from_ir(tree)
+    def compile_ir():
+        scanner = _Scanner(filename, source)
+        tree = _Parser(scanner, autoescape).parse()
+        tree.filename = filename
+        if include is not None:
+            ir.inline_includes(tree, include)
+        return tree
+    if ir_only:
+        return compile_ir()
+    options = ('text', autoescape)
+    if constants:
+        options += (sorted(constants.iteritems()),)
+    return kajiki.template.from_source(
+        source, filename, lambda: ir.optimize_ir(compile_ir(), constants),
+        options, buffered, cache, include)
 
 class _Scanner(object):
 
@@ -58,7 +75,12 @@ class _Scanner(object):
 
     def __iter__(self):
         source = self.source
-        for mo in _re_pattern.finditer(source):
+        scan = 0
+        while True:
+            # Resume after the last token, which may span several matches
+            mo = _re_pattern.search(source, max(scan, self.pos))
+            if mo is None: break
+            scan = mo.end()
             start = mo.start()
             if start > self.pos:
                 yield self.text(source[self.pos:start])
@@ -134,14 +156,15 @@ class _Scanner(object):
         return self.tag(tagname, body)
 
     def _get_braced_expr(self):
-        try:
-            compile(self.source[self.pos:], '', 'eval')
-        except SyntaxError, se:
-            end = se.offset+self.pos
-            text = self.source[self.pos:end-1]
-            self.pos = end
-            return self.expr(text)
-    
+        end = braced_expr_end(self.source, self.pos)
+        if end < 0:
+            raise SyntaxError('Unterminated expression', (
+                    self.filename, self.lineno, None,
+                    self.source[self.pos-2:].split('\n', 1)[0]))
+        text = self.source[self.pos:end]
+        self.pos = end + 1
+        return self.expr(text)
+
 class _Parser(object):
 
     def __init__(self, tokenizer, autoescape=False):
@@ -230,6 +253,13 @@ class _Parser(object):
         body = list(self._parse_body('end'))
         return ir.ForNode(token.body, *body[:-1])
 
+    def _parse_cache(self, token):
+        body = list(self._parse_body('end'))
+        node = ir.CacheNode(token.body.strip(), *body[:-1])
+        node.filename = token.filename
+        node.lineno = token.lineno
+        return node
+
     def _parse_switch(self, token):
         body = list(self._parse_body('end'))
         return ir.SwitchNode(token.body, *body[:-1])
@@ -292,6 +322,8 @@ class _Parser(object):
             return ir.ExprNode(decl)
 
 class _Token(object):
+    __slots__ = ('filename', 'lineno', 'text')
+
     def __init__(self, filename, lineno, text):
         self.filename = filename
         self.lineno = lineno
@@ -302,9 +334,11 @@ class _Token(object):
             self.__class__.__name__,
             self.text)
 
-class _Expr(_Token): pass
-class _Text(_Token): pass
+class _Expr(_Token): __slots__ = ()
+class _Text(_Token): __slots__ = ()
 class _Tag(_Token):
+    __slots__ = ('tagname', 'body')
+
     def __init__(self, filename, lineno, tagname, body):
         self.tagname = tagname
         self.body = body
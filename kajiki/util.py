@@ -1,5 +1,5 @@
+import re
 import sys
-from random import randint
 from threading import local
 
 def debug():# pragma no cover
@@ -31,6 +31,7 @@ class Undefined(object): pass
 UNDEFINED=Undefined()
 
 class flattener(object):
+    __slots__ = ('iterator',)
 
     def __init__(self, iterator):
         while type(iterator) == flattener:
@@ -63,13 +64,57 @@ class flattener(object):
         return s
 
     def __iter__(self):
-        for x in self.iterator:
-            if type(x) == flattener:
-                for xx in x:
-                    if xx is not None:
-                        yield xx
-            elif x is not None:
-                yield x
+        # Walk nested flatteners with an explicit stack so that a chunk
+        # costs the same no matter how deeply its flattener is nested
+        iter_stack = []
+        push, pop = iter_stack.append, iter_stack.pop
+        it = iter(self.iterator)
+        while True:
+            for x in it:
+                if type(x) == flattener:
+                    push(it)
+                    it = iter(x.iterator)
+                    break
+                elif x is not None:
+                    yield x
+            else:
+                if not iter_stack: return
+                it = pop()
+
+class rendered(unicode):
+    '''Text produced by a buffered template function.  It has already been
+    escaped, so it is passed through untouched when used in an expression.'''
+    __slots__ = ()
+
+    def __html__(self):
+        return self
+
+    @classmethod
+    def join(cls, chunks):
+        return cls(join_text(chunks))
+
+def join_text(chunks):
+    '''Join the chunks of text output by template code, leaving out None
+    values and rendering nested flatteners'''
+    try:
+        return u''.join(chunks)
+    except TypeError:
+        # Slow path for None values, nested flatteners and non-text
+        # values from unescaped expressions
+        return u''.join(_text_chunks(chunks))
+
+def _text_chunks(chunks):
+    for chunk in chunks:
+        if chunk is None:
+            continue
+        if type(chunk) == flattener:
+            for x in chunk:
+                if isinstance(x, basestring): yield x
+                else: yield unicode(x)
+        elif isinstance(chunk, basestring):
+            yield chunk
+        else:
+            yield unicode(chunk)
 
 def literal(text):
     return flattener(iter([text]))
@@ -87,6 +132,8 @@ class NameGen(object):
 
     def _gen(self, hint):
         r = hint
+        if r in self.names:
+            from random import randint
         while r in self.names:
             r = '%s_%d' % (hint, randint(0, len(self.names)*10))
         self.names.add(r)
@@ -95,3 +142,36 @@ class NameGen(object):
 def gen_name(hint='_kj_'):
     return NameGen.gen(hint)
     
+
+# The tokens of a Python expression which matter to find where it ends:
+# string literals, brackets and comments, and runs of anything else
+_expr_token = re.compile(r"""
+(?P<string>\'\'\'[^\'\\]*(?:(?:\\.|\'(?!\'\'))[^\'\\]*)*\'\'\'
+  | \"\"\"[^\"\\]*(?:(?:\\.|\"(?!\"\"))[^\"\\]*)*\"\"\"
+  | \'[^\'\\\n]*(?:\\.[^\'\\\n]*)*\'
+  | \"[^\"\\\n]*(?:\\.[^\"\\\n]*)*\") |
+(?P<open>[([{]) |
+(?P<close>[)\]}]) |
+(?P<comment>\#[^\n]*) |
+(?P<other>[^\'\"()[\]{}\#]+)
+""", re.VERBOSE | re.DOTALL)
+
+def braced_expr_end(source, pos):
+    '''Return the index of the brace which closes the Python expression
+    starting at pos in source (just after a "${"), or -1 if the expression is
+    not closed.  Only the tokens of the expression itself are scanned.'''
+    match = _expr_token.match
+    depth = 0
+    while True:
+        mo = match(source, pos)
+        if mo is None:
+            return -1
+        kind = mo.lastgroup
+        if kind == 'open':
+            depth += 1
+        elif kind == 'close':
+            if not depth:
+                if mo.group() == '}': return pos
+                return -1
+            depth -= 1
+        pos = mo.end()
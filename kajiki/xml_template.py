@@ -1,18 +1,17 @@
 import re
+from ast import literal_eval
 from ddict import defaultdict
 from cStringIO import StringIO
 from xml import sax
 from htmllib import HTMLParser
-from xml.dom import minidom as dom
 
 import kajiki
 from kajiki import ir
 from kajiki import template
+from kajiki.util import gen_name, braced_expr_end
 from markup_template import QDIRECTIVES, QDIRECTIVES_DICT
 from html_utils import HTML_OPTIONAL_END_TAGS
 
-impl = dom.getDOMImplementation(' ')
-
 _pattern = r'''
 \$(?:
     (?P<expr_escaped>\$) |      # Escape $$
@@ -33,15 +32,30 @@ def XMLTemplate(
         mode = 'xml'
         force_mode = False
     is_fragment = kw.pop('is_fragment', False)
+    buffered = kw.pop('buffered', False)
+    cache = kw.pop('cache', None)
+    include = kw.pop('include', None)
+    constants = kw.pop('constants', None)
     if source is None:
         source = open(filename).read()
     if filename is None:
         filename = '<string>'
-    doc = _Parser(filename, source).parse()
-    expand(doc)
-    compiler = _Compiler(filename, doc, mode, is_fragment, force_mode)
-    ir_ = compiler.compile()
-    return template.from_ir(ir_)
+    def compile_ir():
+        doc = _Parser(filename, source).parse()
+        expand(doc)
+        compiler = _Compiler(filename, doc, mode, is_fragment, force_mode)
+        tree = compiler.compile()
+        if include is not None:
+            ir.inline_includes(tree, include)
+        return tree
+    if kw.pop('ir_only', False):
+        return compile_ir()
+    options = ('xml', mode, is_fragment, force_mode)
+    if constants:
+        options += (sorted(constants.iteritems()),)
+    return template.from_source(
+        source, filename, lambda: ir.optimize_ir(compile_ir(), constants),
+        options, buffered, cache, include)
 
 def annotate(gen):
     def inner(self, node, *args, **kwargs):
@@ -110,11 +124,11 @@ class _Compiler(object):
         ir_node.lineno = dom_node.lineno
 
     def _compile_node(self, node):
-        if isinstance(node, dom.Comment):
+        if isinstance(node, _Comment):
             return self._compile_comment(node)
-        elif isinstance(node, dom.Text):
+        elif isinstance(node, _Text):
             return self._compile_text(node)
-        elif isinstance(node, dom.ProcessingInstruction):
+        elif isinstance(node, _ProcessingInstruction):
             return self._compile_pi(node)
         elif node.tagName.startswith('py:'):
             # Handle directives
@@ -126,11 +140,20 @@ class _Compiler(object):
 
     @annotate
     def _compile_xml(self, node):
-        content = attrs = guard = None
+        content = attrs = strip = None
         if node.hasAttribute('py:strip'):
-            guard = 'not (%s)' % node.getAttribute('py:strip')
+            strip = node.getAttribute('py:strip').strip()
             node.removeAttribute('py:strip')
-        yield ir.TextNode(u'<%s' % node.tagName, guard)
+            if not strip:
+                # As in Genshi, an empty py:strip always strips the tag
+                strip = True
+            else:
+                try:
+                    strip = bool(literal_eval(strip))
+                except (ValueError, SyntaxError):
+                    pass
+        # The nodes of the opening tag, content and closing tag
+        start, body, end = [ ir.TextNode(u'<%s' % node.tagName) ], [], []
         for k,v in sorted(node.attributes.items()):
             tc = _TextCompiler(self.filename, v, node.lineno,
                                ir.TextNode)
@@ -142,30 +165,48 @@ class _Compiler(object):
             elif k == 'py:attrs':
                 attrs = node.getAttribute('py:attrs')
                 continue
-            yield ir.AttrNode(k, v, guard, self.mode)
+            if all(type(x) == ir.TextNode for x in v):
+                # Static attributes are rendered now and merged with the
+                # surrounding text
+                value = u''.join(x.text for x in v)
+                start.append(ir.TextNode(ir.static_attr(k, value, self.mode)))
+            else:
+                start.append(ir.AttrNode(k, v, None, self.mode))
         if attrs:
-            yield ir.AttrsNode(attrs, guard, self.mode)
+            start.append(ir.AttrsNode(attrs, None, self.mode))
         if content:
-            yield ir.TextNode(u'>', guard)
-            yield ir.ExprNode(content)
-            yield ir.TextNode(u'</%s>' % node.tagName, guard)
+            start.append(ir.TextNode(u'>'))
+            body.append(ir.ExprNode(content))
+            end.append(ir.TextNode(u'</%s>' % node.tagName))
         else:
             if node.childNodes:
-                yield ir.TextNode(u'>', guard)
+                start.append(ir.TextNode(u'>'))
                 for cn in node.childNodes:
-                    for x in self._compile_node(cn):
-                        yield x
+                    body.extend(self._compile_node(cn))
                 if not (self.mode.startswith('html')
                         and node.tagName in HTML_OPTIONAL_END_TAGS):
-                    yield ir.TextNode(u'</%s>' % node.tagName, guard)
+                    end.append(ir.TextNode(u'</%s>' % node.tagName))
             else:
                 if self.mode.startswith('html'):
                     if  node.tagName in HTML_OPTIONAL_END_TAGS:
-                        yield ir.TextNode(u'>', guard)
+                        start.append(ir.TextNode(u'>'))
                     else:
-                        yield ir.TextNode(u'></%s>' % node.tagName, guard)
+                        start.append(ir.TextNode(u'></%s>' % node.tagName))
                 else:
-                    yield ir.TextNode(u'/>', guard)
+                    start.append(ir.TextNode(u'/>'))
+        if strip is True:
+            start, end = [], []
+        elif strip is not None and strip is not False:
+            # The strip expression is evaluated once, and the opening and
+            # closing tags are each rendered by a single test of its value
+            for x in start + end:
+                self._anno(node, x)
+            guard = gen_name()
+            start = [ ir.AssignNode(guard, 'not (%s)' % strip),
+                      ir.IfNode(guard, *start) ]
+            end = end and [ ir.IfNode(guard, *end) ]
+        for x in start + body + end:
+            yield x
 
     @annotate
     def _compile_replace(self, node):
@@ -223,7 +264,9 @@ class _Compiler(object):
         if self.in_def:
             yield ir.InnerDefNode(node.getAttribute('function'), *body)
         else:
-            self.functions[node.getAttribute('function')] = body
+            decl = node.getAttribute('function')
+            self.functions[decl] = body
+            self.function_lnos[decl] = node.lineno
 
     @annotate
     def _compile_call(self, node):
@@ -238,7 +281,8 @@ class _Compiler(object):
 
     @annotate
     def _compile_text(self, node):
-        tc = _TextCompiler(self.filename, node.data, node.lineno)
+        tc = _TextCompiler(self.filename, node.data, node.lineno,
+                           escaped=True)
         for x in tc:
             yield x
 
@@ -257,6 +301,11 @@ class _Compiler(object):
         yield ir.WithNode(node.getAttribute('vars'),
                           *list(self._compile_nop(node)))
 
+    @annotate
+    def _compile_cache(self, node):
+        yield ir.CacheNode(node.getAttribute('key'),
+                           *list(self._compile_nop(node)))
+
     @annotate
     def _compile_switch(self, node):
         # Filter out text nodes
@@ -288,14 +337,17 @@ class _Compiler(object):
 class _TextCompiler(object):
 
     def __init__(self, filename, source, lineno,
-                 node_type=ir.TranslatableTextNode):
+                 node_type=ir.TranslatableTextNode, escaped=False):
         self.filename = filename
         self.source = source
         self.orig_lineno = lineno
         self.lineno = 0
         self.pos = 0
         self.node_type = node_type
-        
+        # Whether the source is escaped XML text, as the character data of
+        # the elements is
+        self.escaped = escaped
+
     def text(self, text):
         node = self.node_type(text)
         node.lineno = self.real_lineno
@@ -303,6 +355,8 @@ class _TextCompiler(object):
         return node
 
     def expr(self, text):
+        if self.escaped:
+            text = sax.saxutils.unescape(text)
         node = ir.ExprNode(text)
         node.lineno = self.real_lineno
         self.lineno += text.count('\n')
@@ -314,7 +368,10 @@ class _TextCompiler(object):
 
     def __iter__(self):
         source = self.source
-        for mo in _re_pattern.finditer(source):
+        while True:
+            # Resume after the last token, which may span several matches
+            mo = _re_pattern.search(source, self.pos)
+            if mo is None: break
             start = mo.start()
             if start > self.pos:
                 yield self.text(source[self.pos:start])
@@ -339,21 +396,127 @@ class _TextCompiler(object):
             yield self.text(source[self.pos:])
 
     def _get_braced_expr(self):
-        try:
-            compile(self.source[self.pos:], '', 'eval')
-        except SyntaxError, se:
-            end = se.offset+self.pos
-            text = self.source[self.pos:end-1]
-            self.pos = end
-            return self.expr(text)
-    
+        end = braced_expr_end(self.source, self.pos)
+        if end < 0:
+            raise SyntaxError('Unterminated expression', (
+                    self.filename, self.real_lineno, None,
+                    self.source[self.pos-2:].split('\n', 1)[0]))
+        text = self.source[self.pos:end]
+        self.pos = end + 1
+        return self.expr(text)
+
+class _Node(object):
+    '''A node of the tree of a template parsed by _Parser.  The nodes are
+    lightweight versions of the xml.dom ones, with the same names.'''
+    __slots__ = ('lineno',)
+
+class _Element(_Node):
+    __slots__ = ('tagName', 'attributes', 'childNodes')
+
+    def __init__(self, tagName, attributes, lineno=0):
+        self.tagName = tagName
+        self.attributes = attributes
+        self.childNodes = []
+        self.lineno = lineno
+
+    def hasAttribute(self, name):
+        return name in self.attributes
+
+    def getAttribute(self, name):
+        return self.attributes.get(name, u'')
+
+    def setAttribute(self, name, value):
+        self.attributes[name] = value
+
+    def removeAttribute(self, name):
+        del self.attributes[name]
+
+    def toxml(self):
+        attrs = u''.join(u' %s=%s' % (k, sax.saxutils.quoteattr(v))
+                         for k, v in sorted(self.attributes.items()))
+        if not self.childNodes:
+            return u'<%s%s/>' % (self.tagName, attrs)
+        return u'<%s%s>%s</%s>' % (
+            self.tagName, attrs, u''.join(x.toxml() for x in self.childNodes),
+            self.tagName)
+
+class _Text(_Node):
+    # data is escaped XML text
+    __slots__ = ('data',)
+
+    def __init__(self, data, lineno=0):
+        self.data = data
+        self.lineno = lineno
+
+    def toxml(self):
+        return self.data
+
+class _Comment(_Text):
+    __slots__ = ()
+
+    def toxml(self):
+        return u'<!--%s-->' % self.data
+
+class _ProcessingInstruction(_Node):
+    __slots__ = ('target', 'data')
+
+    def __init__(self, target, data, lineno=0):
+        self.target = target
+        self.data = data
+        self.lineno = lineno
+
+    def toxml(self):
+        return u'<?%s %s?>' % (self.target, self.data)
+
+class _DocumentType(object):
+    __slots__ = ('name', 'publicId', 'systemId')
+
+    def __init__(self, name, publicId, systemId):
+        self.name = name
+        self.publicId = publicId
+        self.systemId = systemId
+
+    def toxml(self):
+        # As written by xml.dom.minidom
+        if self.publicId:
+            return u"<!DOCTYPE %s  PUBLIC '%s'  '%s'>" % (
+                self.name, self.publicId, self.systemId)
+        elif self.systemId:
+            return u"<!DOCTYPE %s  SYSTEM '%s'>" % (self.name, self.systemId)
+        return u'<!DOCTYPE %s>' % self.name
+
+class _Document(object):
+    __slots__ = ('childNodes', 'doctype', 'expanded')
+
+    def __init__(self):
+        self.childNodes = []
+        self.doctype = None
+        # Whether the directives of the elements have been expanded
+        self.expanded = False
+
+    @property
+    def firstChild(self):
+        return self.childNodes and self.childNodes[0] or None
+
+    def toxml(self):
+        parts = [ u'<?xml version="1.0" ?>' ]
+        if self.doctype is not None:
+            parts.append(self.doctype.toxml())
+        parts.extend(x.toxml() for x in self.childNodes)
+        return u''.join(parts)
+
 class _Parser(sax.ContentHandler):
+    '''Parses a template into a tree of _Nodes, whose directives are
+    expanded as each element is read'''
 
     def __init__(self, filename, source):
         self._filename = filename
         self._source = source
         self._doc = None
         self._els = []
+        # The pieces of the text being read, and the line where it starts
+        self._text = []
+        self._text_lineno = 0
 
     def parse(self):
         self._parser = parser = sax.make_parser()
@@ -368,33 +531,46 @@ class _Parser(sax.ContentHandler):
         parser.parse(source)
         return self._doc
 
+    def _append(self, node):
+        self._flush_text()
+        self._els[-1].childNodes.append(node)
+
+    def _flush_text(self):
+        # The text is reported in several pieces (around entities and at
+        # the boundaries of the parser's buffer), which may split an
+        # expression: they make a single node
+        if self._text:
+            node = _Text(u''.join(self._text), self._text_lineno)
+            self._text = []
+            self._els[-1].childNodes.append(node)
+
     ## ContentHandler implementation
     def startDocument(self):
-        self._doc = dom.Document()
+        self._doc = _Document()
+        self._doc.expanded = True
         self._els.append(self._doc)
 
+    def endDocument(self):
+        self._flush_text()
+
     def startElement(self, name, attrs):
-        el = self._doc.createElement(name)
-        el.lineno = self._parser.getLineNumber()
-        for k,v in attrs.items():
-            el.setAttribute(k,v)
-        self._els[-1].appendChild(el)
+        el = _Element(name, dict(attrs.items()),
+                      self._parser.getLineNumber())
+        self._append(_expand_element(el))
         self._els.append(el)
 
     def endElement(self, name):
-        popped = self._els.pop()
-        assert name == popped.tagName
+        self._flush_text()
+        self._els.pop()
 
     def characters(self, content):
-        content = sax.saxutils.escape(content)
-        node = self._doc.createTextNode(content)
-        node.lineno = self._parser.getLineNumber()
-        self._els[-1].appendChild(node)
+        if not self._text:
+            self._text_lineno = self._parser.getLineNumber()
+        self._text.append(sax.saxutils.escape(content))
 
     def processingInstruction(self, target, data):
-        node = self._doc.createProcessingInstruction(target, data)
-        node.lineno = self._parser.getLineNumber()
-        self._els[-1].appendChild(node)
+        self._append(_ProcessingInstruction(
+                target, data, self._parser.getLineNumber()))
 
     def skippedEntity(self, name):
         content = unicode(HTMLParser.entitydefs[name], 'latin-1')
@@ -414,49 +590,52 @@ class _Parser(sax.ContentHandler):
 
     # LexicalHandler implementation
     def comment(self, text):
-        node = self._doc.createComment(text)
-        node.lineno = self._parser.getLineNumber()
-        self._els[-1].appendChild(node)
+        self._append(_Comment(text, self._parser.getLineNumber()))
 
     def startCDATA(self): pass
     def endCDATA(self): pass
     def startDTD(self, name, pubid, sysid):
-        self._doc.doctype = impl.createDocumentType(name, pubid, sysid)
+        self._doc.doctype = _DocumentType(name, pubid, sysid)
     def endDTD(self): pass
 
-def expand(tree, parent=None):
-    if isinstance(tree, dom.Document):
-        expand(tree.firstChild, tree)
+def expand(tree):
+    '''Replace the directive tags and attributes of the elements in tree by
+    directive elements wrapping them, and return the new tree.  The
+    documents built by _Parser are expanded while they are parsed.'''
+    if isinstance(tree, _Document):
+        if not tree.expanded:
+            tree.childNodes = [ expand(x) for x in tree.childNodes ]
+            tree.expanded = True
         return tree
-    if not isinstance(getattr(tree, 'tagName', None), basestring):
+    if not isinstance(tree, _Element):
         return tree
-    if tree.tagName in QDIRECTIVES_DICT:
-        tree.setAttribute(
-            tree.tagName,
-            tree.getAttribute(QDIRECTIVES_DICT[tree.tagName]))
-        tree.tagName = 'py:nop'
-    if tree.tagName != 'py:nop' and tree.hasAttribute('py:extends'):
-        value = tree.getAttribute('py:extends')
-        el = tree.ownerDocument.createElement('py:extends')
-        el.setAttribute('href', value)
-        el.lineno = tree.lineno
-        tree.removeAttribute('py:extends')
-        tree.childNodes.insert(0, el)
+    tree.childNodes = [ expand(x) for x in tree.childNodes ]
+    return _expand_element(tree)
+
+def _expand_element(el):
+    '''Expand the directives of the element el (but not of its children)
+    and return the outermost element'''
+    attrs = el.attributes
+    if el.tagName in QDIRECTIVES_DICT:
+        attrs[el.tagName] = attrs.get(QDIRECTIVES_DICT[el.tagName], u'')
+        el.tagName = 'py:nop'
+    if el.tagName != 'py:nop' and 'py:extends' in attrs:
+        extends = _Element(
+            'py:extends', { 'href': attrs.pop('py:extends') }, el.lineno)
+        el.childNodes.insert(0, extends)
+    outer = inner = el
     for directive, attr in QDIRECTIVES:
-        if not tree.hasAttribute(directive): continue
-        value = tree.getAttribute(directive)
-        tree.removeAttribute(directive)
-        # nsmap = (parent is not None) and parent.nsmap or tree.nsmap
-        el = tree.ownerDocument.createElement(directive)
-        el.lineno = tree.lineno
+        if directive not in attrs: continue
+        value = attrs.pop(directive)
         if attr:
-            el.setAttribute(attr, value)
-        # el.setsourceline = tree.sourceline
-        parent.replaceChild(newChild=el, oldChild=tree)
-        el.appendChild(tree)
-        expand(tree, el)
-        return el
-    for child in tree.childNodes:
-        expand(child, tree)
-    return tree
-
+            wrapper = _Element(directive, { attr: value }, el.lineno)
+        else:
+            wrapper = _Element(directive, {}, el.lineno)
+        if inner is el:
+            outer = wrapper
+        else:
+            inner.childNodes.append(wrapper)
+        inner = wrapper
+    if inner is not el:
+        inner.childNodes.append(el)
+    return outer